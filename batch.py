@@ -0,0 +1,202 @@
+"""
+batch.py
+
+Remixes a whole back catalogue in one go - i.e.: to pre-generate remixes for demo pages.
+Songs are remixed on a pool of worker processes (see helpers/workerpool.py), so startup
+costs are paid once per worker rather than once per song. Every finished song is appended
+to a JSONL manifest along with its status and timing, and songs that are already done
+are skipped - so an interrupted batch can just be run again.
+
+Run from the root of the Wub Machine (samples are loaded from samples/):
+    python batch.py <style> <directory or manifest> [-j workers] [-o output directory] [-m manifest]
+
+Styles are the remixer class names: Dubstep, ElectroHouse, DoubleTime, Beatbox.
+An input manifest has one song per line: either a path, or a JSON object
+with an "infile" (and optionally an "outfile") - so a batch's own manifest can be fed back in.
+
+by Peter Sobot <hi@petersobot.com>
+"""
+import json, time, os, logging, traceback, argparse, config
+import tornado.ioloop
+from helpers.workerpool import WorkerPool
+
+from remixers.dubstep import Dubstep
+from remixers.electrohouse import ElectroHouse
+from remixers.doubletime import DoubleTime
+from remixers.beatbox import Beatbox
+remixers = dict([(r.__name__.lower(), r) for r in [Dubstep, ElectroHouse, DoubleTime, Beatbox]])
+
+def songs(source):
+    """
+        Input files from a directory (every file with an allowed extension, in order),
+        or from a manifest. Returns a list of {'infile': ..., ['outfile': ...]} dicts.
+    """
+    if os.path.isdir(source):
+        return [{'infile': os.path.join(source, f)} for f in sorted(os.listdir(source))
+                if os.path.splitext(f)[1].lower() in config.allowed_file_extensions]
+    items = []
+    for line in open(source):
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('{'):
+            items.append(json.loads(line))
+        else:
+            items.append({'infile': line})
+    return items
+
+def finished(manifest, style):
+    """
+        Input files that a previous run has already remixed (in the given style) into an outfile that still exists.
+    """
+    done = {}
+    if os.path.isfile(manifest):
+        for line in open(manifest):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue    #   i.e.: the last line of a batch that was killed mid-write
+            if record.get('style') == style:
+                done[record['infile']] = record['status'] == 'done' and os.path.isfile(record['outfile'])
+    return set([infile for infile, ok in done.iteritems() if ok])
+
+class Job():
+    """
+        The parent of one remix in a batch: hears when it's finished, and tells the batch.
+    """
+    def __init__(self, batch, item):
+        self.batch = batch
+        self.item = item
+        self.ioloop = batch.ioloop
+        self.started = None
+
+    def finish(self, uid, final=None):
+        self.batch.finish(self, final)
+
+class Batch():
+    def __init__(self, style, items, outdir, manifest, workers, verbose=False):
+        self.log = logging.getLogger()
+        self.style = style
+        self.ioloop = tornado.ioloop.IOLoop.instance()
+        self.verbose = verbose
+        self.workers = workers
+        self.manifest = manifest
+        self.pending = []
+        self.running = []
+        self.results = {'done': 0, 'error': 0}
+        self.skipped = 0
+
+        done = finished(manifest, style.__name__)
+        for item in items:
+            item['infile'] = str(item['infile'])
+            if item['infile'] in done:
+                self.skipped += 1
+                continue
+            if not item.get('outfile'):
+                uid = os.path.splitext(os.path.basename(item['infile']))[0]
+                item['outfile'] = os.path.join(outdir or os.path.dirname(item['infile']), "%s.%s.mp3" % (uid, style.__name__.lower()))
+            self.pending.append(item)
+
+    def run(self):
+        """
+            Remixes every pending song, then prints a summary. Blocks until they're all done.
+        """
+        self.began = time.time()
+        if self.pending:
+            self.pool = WorkerPool(self, [self.style], self.workers)
+            self.output = open(self.manifest, 'a')
+            try:
+                self.next()
+                self.ioloop.start()
+            finally:
+                self.pool.stop()
+                self.output.close()
+        self.summary(time.time() - self.began)
+
+    def next(self):
+        """
+            Starts pending songs until every worker is busy - skipping any with the same name
+            as one that's already running, as remixers name their temp files after their input.
+        """
+        while len(self.running) < self.workers:
+            uids = [os.path.splitext(os.path.basename(job.item['infile']))[0] for job in self.running]
+            for item in self.pending:
+                if not os.path.splitext(os.path.basename(item['infile']))[0] in uids:
+                    break
+            else:
+                if not self.running:
+                    self.ioloop.stop()
+                return
+            self.pending.remove(item)
+            job = Job(self, item)
+            remixer = self.style(job, item['infile'], item['outfile'], self.progress)
+            remixer.deleteOriginal = False
+            remixer.pool = self.pool
+            job.started = time.time()
+            self.running.append(job)
+            try:
+                remixer.start()
+            except:
+                self.log.error("Could not start remix of %s:\n%s" % (item['infile'], traceback.format_exc()))
+                self.finish(job, None)
+
+    def progress(self, data):
+        if self.verbose:
+            print "\t(%s%%) %s: %s" % (round(data.get('progress', 0) * 100, 2), data.get('uid'), data.get('text'))
+
+    def finish(self, job, final):
+        """
+            Records a finished (or failed) song in the manifest, and starts the next one.
+        """
+        if not job in self.running:
+            return
+        self.running.remove(job)
+        final = final or {'status': -1, 'text': "Remix never started, or timed out."}
+        record = {
+            'infile': job.item['infile'],
+            'outfile': job.item['outfile'],
+            'style': self.style.__name__,
+            'status': 'error' if final.get('status') == -1 else 'done',
+            'started': job.started,
+            'seconds': round(time.time() - job.started, 3),
+        }
+        if record['status'] == 'error':
+            record['error'] = final.get('debug') or final.get('text')
+        if final.get('stats'):
+            record['stats'] = final['stats']
+        self.output.write(json.dumps(record) + "\n")
+        self.output.flush()
+        self.results[record['status']] += 1
+
+        count = sum(self.results.values())
+        total = count + len(self.running) + len(self.pending)
+        print "[%s/%s] %s %s in %ss" % (count, total, record['status'], record['infile'], record['seconds'])
+        self.ioloop.add_callback(self.next)
+
+    def summary(self, elapsed):
+        count = sum(self.results.values())
+        print "Remixed %s songs (%s failed, %s already done) in %.1fs." % (count, self.results['error'], self.skipped, elapsed)
+        if count and elapsed:
+            print "Throughput: %.2f songs per minute with %s workers (%.1fs per song)." % (count * 60.0 / elapsed, self.workers, elapsed / count)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Remix a directory (or manifest) of songs in one style.")
+    parser.add_argument('style', help="remixer to use: %s" % ', '.join(sorted(remixers.keys())))
+    parser.add_argument('source', help="directory of songs, or a manifest of them")
+    parser.add_argument('-j', '--workers', type=int, default=max(1, config.worker_pool_size), help="number of worker processes")
+    parser.add_argument('-o', '--outdir', default=None, help="where to put remixes (default: next to each song)")
+    parser.add_argument('-m', '--manifest', default='batch.jsonl', help="JSONL file of results, used to skip songs already done")
+    parser.add_argument('-v', '--verbose', action='store_true', help="print progress updates")
+    args = parser.parse_args()
+
+    if not args.style.lower() in remixers:
+        parser.error("Unknown style %s." % args.style)
+    if not os.path.exists(args.source):
+        parser.error("%s does not exist." % args.source)
+    if args.workers < 1:
+        parser.error("At least one worker is needed.")
+    if args.outdir and not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+    logging.basicConfig(format=config.log_format, level=logging.WARNING)
+    Batch(remixers[args.style.lower()], songs(args.source), args.outdir, args.manifest, args.workers, args.verbose).run()
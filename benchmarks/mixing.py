@@ -0,0 +1,89 @@
+"""
+mixing.py
+
+Benchmarks the old way of mixing a Dubstep section - audio.mix() followed by
+the old copy-and-scale truncatemix() - against a single audiobuffer.mix() call.
+Prints the time per section, the peak memory of a process that mixes nothing
+but sections, and the largest difference between the two outputs.
+
+Each approach runs in its own process, so peak RSS isn't shared between them.
+
+Usage (from the root of the repository):
+    python -m benchmarks.mixing [number of sections]
+"""
+from helpers import audiobuffer
+from multiprocessing import Process, Queue
+import echonest.audio as audio
+import numpy, time, sys, resource
+
+SAMPLE_RATE = 44100
+
+def noise(seconds, seed):
+    """
+        Loud stereo noise - loud enough that the old mix would wrap around now and then.
+    """
+    numpy.random.seed(seed)
+    data = (numpy.random.standard_normal((int(seconds * SAMPLE_RATE), 2)) * 12000).clip(-32768, 32767).astype(numpy.int16)
+    return audio.AudioData(ndarray=data, sampleRate=SAMPLE_RATE, numChannels=2, defer=False, verbose=False)
+
+def truncatemix(dataA, dataB, mix=0.5):
+    """
+        Remixer.truncatemix as it used to be.
+    """
+    newdata = audio.AudioData(ndarray=dataA.data, sampleRate=dataA.sampleRate,
+        numChannels=dataA.numChannels, defer=False, verbose=False)
+    newdata.data *= float(mix)
+    if dataB.endindex > dataA.endindex:
+        newdata.data[:] += dataB.data[:dataA.endindex] * (1 - float(mix))
+    else:
+        newdata.data[:dataB.endindex] += dataB.data[:] * (1 - float(mix))
+    return newdata
+
+def legacy(wubs, splash, orig, mixfactor):
+    return truncatemix(audio.mix(wubs, splash), orig, mixfactor)
+
+def kernel(wubs, splash, orig, mixfactor):
+    return audiobuffer.mix([
+        (wubs, 0.5 * mixfactor),
+        (splash, 0.5 * mixfactor),
+        (orig, 1 - mixfactor)
+    ], max(len(wubs), len(splash)))
+
+def inputs():
+    #   One 140bpm bar of wubs, a shorter splash, and a slightly long stretched bar of the original.
+    return noise(60.0 * 8 / 140, 1), noise(1.5, 2), noise(60.0 * 8 / 140 + 0.1, 3), 0.6
+
+def bench(approach, sections, results):
+    wubs, splash, orig, mixfactor = inputs()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for i in xrange(sections):
+        start = time.time()
+        out = approach(wubs, splash, orig, mixfactor)
+        times.append(time.time() - start)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((times, peak - baseline, audiobuffer.frames(out).copy()))
+
+if __name__ == "__main__":
+    sections = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    print "Mixing %s sections..." % sections
+    outputs = {}
+    for name, approach in [('audio.mix', legacy), ('audiobuffer', kernel)]:
+        results = Queue()
+        p = Process(target=bench, args=(approach, sections, results))
+        p.start()
+        times, rss, outputs[name] = results.get()
+        p.join()
+        print "%-12s mean %7.2fms  min %7.2fms  max %7.2fms per section, peak RSS +%6.1fMB" % (
+            name, 1000 * sum(times) / len(times), 1000 * min(times), 1000 * max(times), rss / 1024.0
+        )
+
+    #   Compare against an exact float64 mix, clipped - the old path wraps where this saturates.
+    wubs, splash, orig, mixfactor = inputs()
+    n = len(wubs)
+    exact = wubs.data[:n] * 0.5 * mixfactor
+    exact[:len(splash)] += splash.data * 0.5 * mixfactor
+    exact += orig.data[:n] * (1 - mixfactor)
+    exact = exact.clip(-32768, 32767)
+    for name, out in outputs.iteritems():
+        print "%-12s max error %6d, mean error %.3f" % (name, numpy.abs(out - exact).max(), numpy.abs(out - exact).mean())
@@ -0,0 +1,147 @@
+"""
+remix.py
+
+Benchmarks whole remixes, end to end, without the Echo Nest.
+Each remixer is run on a synthetic song (see benchmarks/synthetic.py) with a stand-in analysis,
+and timed stage by stage from its progress updates:
+    startup - starting the remix process
+    lookup  - reading the input's tags and artwork
+    listen  - decoding (and "analysing") the input
+    arrange - choosing key, tempo and samples
+    mix     - rendering and encoding sections
+    master  - finishing the MP3
+    tag     - writing the output's tags
+The peak memory use (RSS) of each remix process is recorded too. Each remix runs
+under its own benchmark process, so peaks aren't carried over from one remix to the next.
+Results are written to a JSON file, so runs can be compared.
+
+Needs en-ffmpeg and lame, as remixing does. Usage (from the root of the repository):
+    python -m benchmarks.remix [-s Dubstep,ElectroHouse,DoubleTime] [-l seconds] [-t tempo] [-k key] [-o results.json]
+"""
+from benchmarks import synthetic
+from multiprocessing import Process, Queue
+import json, time, os, shutil, tempfile, traceback, resource, platform, argparse, config
+
+from remixers.dubstep import Dubstep
+from remixers.electrohouse import ElectroHouse
+from remixers.doubletime import DoubleTime
+remixers = dict([(r.__name__, r) for r in [Dubstep, ElectroHouse, DoubleTime]])
+
+#   Stage of a remix, by the beginning of the progress text that starts it
+STAGES = [
+    ('Starting', 'startup'),
+    ('Looking up', 'lookup'),
+    ('Listening', 'listen'),
+    ('Choosing', 'arrange'),
+    ('Finding', 'arrange'),
+    ('Arranging', 'mix'),
+    ('Adding ending', 'mix'),
+    ('Shifting', 'mix'),
+    ('Replacing', 'mix'),
+    ('Mastering', 'master'),
+    ('Encoding', 'master'),
+    ('Adding artwork', 'tag'),
+]
+
+def stage(text):
+    for prefix, name in STAGES:
+        if text and text.startswith(prefix):
+            return name
+    return 'other'
+
+class Watcher():
+    """
+        Parent of the remixer being benchmarked: keeps the time of every progress update.
+    """
+    def __init__(self):
+        self.updates = []
+        self.final = None
+
+    def progress(self, data):
+        self.updates.append((data.get('time'), data.get('text')))
+
+    def finish(self, uid, final=None):
+        self.final = final
+
+    def stages(self, started):
+        """
+            Seconds spent in each stage: from the update that starts it to the next update.
+        """
+        stages = {}
+        times = [(started, 'Starting')] + [(t, text) for t, text in self.updates if t]
+        for (t, text), (end, next) in zip(times, times[1:]):
+            name = stage(text)
+            stages[name] = round(stages.get(name, 0) + end - t, 4)
+        return stages
+
+def run(cls, filename, analysis, outfile, results):
+    """
+        Runs in its own process: remixes one song, then reports back - even if the remix couldn't start.
+    """
+    watcher = Watcher()
+    started = time.time()
+    result = {'style': cls.__name__, 'status': 'error', 'error': None}
+    try:
+        remixer = cls(watcher, filename, outfile, watcher.progress)
+        remixer.deleteOriginal = False
+        remixer.analysis_provider = lambda infile: analysis
+        remixer.start()
+        remixer.join()
+        final = watcher.final or {}
+        if final.get('status', -1) != -1:
+            result['status'] = 'done'
+        result['error'] = final.get('debug')
+        result['timings'] = final.get('timings')     #   As timed by the remix process itself
+    except:
+        result['error'] = traceback.format_exc()
+    result.update({
+        'total': round(time.time() - started, 4),
+        'stages': watcher.stages(started),
+        'peak_rss': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,   # ru_maxrss is in kilobytes
+        'output_bytes': os.path.getsize(outfile) if os.path.isfile(outfile) else 0,
+    })
+    results.put(result)
+
+def bench(cls, seconds, tempo, key, directory):
+    filename = os.path.join(directory, "%s.wav" % cls.__name__.lower())
+    analysis = synthetic.song(filename, seconds, tempo, key)
+    results = Queue()
+    p = Process(target=run, args=(cls, filename, analysis, os.path.join(directory, "%s.mp3" % cls.__name__.lower()), results))
+    p.start()
+    result = results.get()
+    p.join()
+    result['song_seconds'] = round(analysis.duration, 3)
+    result['realtime'] = round(analysis.duration / result['total'], 3) if result['total'] else None
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time whole remixes of synthetic songs.")
+    parser.add_argument('-s', '--styles', default=','.join(sorted(remixers.keys())), help="comma-separated remixers to run")
+    parser.add_argument('-l', '--length', type=float, default=120.0, help="length of the synthetic song, in seconds")
+    parser.add_argument('-t', '--tempo', type=float, default=120.0)
+    parser.add_argument('-k', '--key', type=int, default=9, help="0 (C) to 11 (B)")
+    parser.add_argument('-o', '--output', default='benchmark.json', help="JSON file to write results to")
+    args = parser.parse_args()
+
+    config.progress_interval = 0    #   Every progress update marks a stage, so none can be coalesced
+    directory = tempfile.mkdtemp(prefix='wub-bench-')
+    results = []
+    try:
+        for style in args.styles.split(','):
+            result = bench(remixers[style.strip()], args.length, args.tempo, args.key, directory)
+            results.append(result)
+            print "%s: %s in %.2fs (%sx realtime), peak RSS %.1fMB" % (result['style'], result['status'], result['total'], result['realtime'], result['peak_rss'] / 1048576.0)
+            for name, t in sorted(result['stages'].items(), key=lambda x: -x[1]):
+                print "\t%s\t%.3fs" % (name, t)
+    finally:
+        shutil.rmtree(directory, True)
+
+    json.dump({
+        'time': time.time(),
+        'machine': platform.platform(),
+        'python': platform.python_version(),
+        'song': {'seconds': args.length, 'tempo': args.tempo, 'key': args.key},
+        'config': dict([(k, getattr(config, k, None)) for k in ['time_stretch_engine', 'stream_encoding', 'memmap_source', 'section_workers']]),
+        'results': results,
+    }, open(args.output, 'w'), indent=2)
+    print "Results written to %s." % args.output
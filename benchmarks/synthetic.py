@@ -0,0 +1,144 @@
+"""
+synthetic.py
+
+Synthetic songs for benchmarking remixers without the Echo Nest.
+song() writes a WAV of a chord progression at a known tempo and key, with a kick on
+every beat and a hat on every offbeat, and returns a stand-in analysis for it that has
+everything the remixers use: sections, bars, beats, tatums and segments (with pitches,
+timbre and loudness), plus key, mode, tempo, time signature, loudness and duration.
+
+Hand it to a remixer with:
+    remixer.analysis_provider = lambda infile: analysis
+
+by Peter Sobot <hi@petersobot.com>
+"""
+import echonest.audio as audio
+import numpy, wave
+
+SAMPLE_RATE = 44100
+PROGRESSION = [(0, 4), (9, 3), (5, 4), (7, 4)]    #   I - vi - IV - V: (semitones above the key, third)
+BARS_PER_SECTION = 8
+
+class Quantum():
+    """
+        Stands in for an echonest AudioQuantum: a beat, bar, section, tatum or segment.
+    """
+    def __init__(self, start, duration, kind, confidence=1.0):
+        self.start = start
+        self.duration = duration
+        self.end = start + duration
+        self.kind = kind
+        self.confidence = confidence
+        self.source = None
+        self.kids = []
+
+    def children(self):
+        return self.kids
+
+    def __repr__(self):
+        return "<%s %.3f - %.3f>" % (self.kind, self.start, self.end)
+
+class Analysis():
+    """
+        Stands in for an echonest AudioAnalysis.
+    """
+    def __init__(self, duration, tempo, key, sections, bars, beats, tatums, segments):
+        self.duration = duration
+        self.tempo = {'value': tempo, 'confidence': 1.0}
+        self.key = {'value': key, 'confidence': 1.0}
+        self.mode = {'value': 1, 'confidence': 1.0}
+        self.time_signature = 4
+        self.loudness = float(numpy.mean([s.loudness_max for s in segments])) if segments else -60.0
+        self.metadata = {'title': 'Synthetic %s bpm' % tempo, 'artist': 'Wub Machine Benchmarks'}
+        self.sections = sections
+        self.bars = bars
+        self.beats = beats
+        self.tatums = tatums
+        self.segments = segments
+        self.source = None
+
+def quanta(items):
+    result = audio.AudioQuantumList()
+    result.extend(items)
+    return result
+
+def chord(bar, key):
+    """
+        Pitch classes of the root, third and fifth of the chord played in a bar.
+    """
+    root, third = PROGRESSION[bar % len(PROGRESSION)]
+    return [(key + root) % 12, (key + root + third) % 12, (key + root + 7) % 12]
+
+def beat(notes, length, random):
+    """
+        One beat of audio, as float64 stereo: the chord, a kick on the beat and a hat on the offbeat.
+    """
+    t = numpy.arange(length) / float(SAMPLE_RATE)
+    signal = sum(numpy.sin(2 * numpy.pi * 220.0 * 2 ** ((n - 9) / 12.0) * t) for n in notes) * 4000
+    kick = min(length, SAMPLE_RATE / 10)
+    signal[:kick] += numpy.sin(2 * numpy.pi * 55.0 * t[:kick]) * numpy.exp(-t[:kick] * 40) * 16000
+    hat = min(length - length / 2, SAMPLE_RATE / 40)
+    signal[length / 2:length / 2 + hat] += random.standard_normal(hat) * numpy.exp(-t[:hat] * 200) * 6000
+    return numpy.column_stack((signal, signal))
+
+def segment(start, duration, notes, onbeat, random):
+    s = Quantum(start, duration, 'segment')
+    pitches = random.uniform(0, 0.2, 12)
+    pitches[notes] = [1.0, 0.8, 0.7]
+    s.pitches = list(pitches)
+    if onbeat:     #   Sounds like a kick
+        s.timbre = [40.0, 10.0, 20.0, 90.0] + list(random.uniform(-20, 20, 8))
+        s.loudness_max = -8.0 + random.uniform(-1, 1)
+    else:           #   Sounds like a hat
+        s.timbre = [30.0, 120.0, -10.0, 80.0, 20.0] + list(random.uniform(-20, 20, 7))
+        s.loudness_max = -14.0 + random.uniform(-1, 1)
+    s.loudness_begin = s.loudness_max - 10
+    return s
+
+def song(filename, seconds=60.0, tempo=120.0, key=9, seed=0):
+    """
+        Writes a synthetic song to filename (16-bit stereo WAV), a bar at a time, and returns its analysis.
+        The song is cut to a whole number of bars, of at least one.
+    """
+    random = numpy.random.RandomState(seed)
+    beatlength = 60.0 / tempo
+    bars = max(1, int(seconds / (beatlength * 4)))
+
+    out = wave.open(filename, 'wb')
+    out.setnchannels(2)
+    out.setsampwidth(2)
+    out.setframerate(SAMPLE_RATE)
+
+    sections, allbars, beats, tatums, segments = [], [], [], [], []
+    written = 0
+    for b in xrange(bars):
+        notes = chord(b, key)
+        if not b % BARS_PER_SECTION:
+            section = Quantum(b * 4 * beatlength, min(BARS_PER_SECTION, bars - b) * 4 * beatlength, 'section')
+            sections.append(section)
+        bar = Quantum(b * 4 * beatlength, 4 * beatlength, 'bar')
+        section.kids.append(bar)
+        allbars.append(bar)
+        for i in xrange(4):
+            start = (b * 4 + i) * beatlength
+            q = Quantum(start, beatlength, 'beat')
+            for j in xrange(2):
+                tatum = Quantum(start + j * beatlength / 2, beatlength / 2, 'tatum')
+                q.kids.append(tatum)
+                tatums.append(tatum)
+                segments.append(segment(tatum.start, tatum.duration, notes, not j, random))
+            bar.kids.append(q)
+            beats.append(q)
+
+            #   Write samples up to the end of this beat, so rounding never drifts
+            end = int(round((start + beatlength) * SAMPLE_RATE))
+            data = beat(notes, end - written, random)
+            out.writeframes(numpy.clip(data, -32768, 32767).astype(numpy.int16).tostring())
+            written = end
+    out.close()
+
+    for section in sections:
+        section.kids = quanta(section.kids)
+    for bar in allbars:
+        bar.kids = quanta(bar.kids)
+    return Analysis(written / float(SAMPLE_RATE), tempo, key, quanta(sections), quanta(allbars), quanta(beats), quanta(tatums), quanta(segments))
@@ -0,0 +1,46 @@
+"""
+timestretch.py
+
+Benchmarks FastModify's tempo-shifting engines against each other.
+Times how long it takes to stretch one bar of synthetic audio with the
+in-process WSOLA engine and with the soundstretch subprocess.
+
+Usage (from the root of the repository):
+    python -m benchmarks.timestretch [number of bars]
+"""
+from helpers.fastmodify import FastModify
+import echonest.audio as audio
+import numpy, time, sys
+
+SAMPLE_RATE = 44100
+
+def bar(tempo=120.0):
+    """
+        One bar of 4/4 at the given tempo: an A minor chord with a click on every beat.
+    """
+    beat = int(SAMPLE_RATE * 60.0 / tempo)
+    t = numpy.arange(beat * 4) / float(SAMPLE_RATE)
+    signal = sum(numpy.sin(2 * numpy.pi * f * t) for f in (220.0, 261.63, 329.63)) * 6000
+    signal[::beat] += 20000
+    data = numpy.clip(signal, -32768, 32767).astype(numpy.int16)
+    return audio.AudioData(ndarray=numpy.column_stack((data, data)), sampleRate=SAMPLE_RATE, numChannels=2, defer=False, verbose=False)
+
+def bench(engine, bars, ratio):
+    st = FastModify(engine)
+    source = bar()
+    times = []
+    for i in xrange(bars):
+        start = time.time()
+        st.shiftTempo(source, ratio)
+        times.append(time.time() - start)
+    return times
+
+if __name__ == "__main__":
+    bars = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    ratio = 140.0 / 120.0
+    print "Stretching %s bars by %.3f..." % (bars, ratio)
+    for engine in ['wsola', 'soundstretch']:
+        times = bench(engine, bars, ratio)
+        print "%-14s mean %7.2fms  min %7.2fms  max %7.2fms per bar" % (
+            engine, 1000 * sum(times) / len(times), 1000 * min(times), 1000 * max(times)
+        )
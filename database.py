@@ -2,7 +2,7 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship, scoped_session
 from sqlalchemy.pool import QueuePool
 from sqlalchemy import Column, Integer, CHAR, DateTime, String, ForeignKey, Boolean, Text, create_engine
-import config, datetime
+import config, datetime, json
 
 Base = declarative_base()
 
@@ -66,6 +66,7 @@ class Event(Base):
     success = Column(Boolean)
     ip = Column(String)
     detail = Column(Text)
+    resources = Column(Text)    #   JSON of what the remix process cost (see helpers/procstats.py), for remix events
     track = relationship("Track")
 
     def __init__(self, uid, action, success = None, ip = None, detail = None):
@@ -84,6 +85,12 @@ class Event(Base):
         except:
             return datetime.timedelta(0)
 
+    def usage(self):
+        try:
+            return json.loads(self.resources) if self.resources else None
+        except ValueError:
+            return None
+
 
 ###
 # DB Connection Handling
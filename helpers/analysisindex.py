@@ -0,0 +1,133 @@
+"""
+analysisindex.py
+
+Precomputed lookups over an Echo Nest analysis.
+
+The remixers used to query segments with echonest.selection filters, i.e.:
+    segments.that(overlap_range(start, end))
+    beats.that(overlap_ends_of(segments.that(have_pitch_max(pitch)).that(overlap_starts_of(beats))))
+each of which scans every segment in the song, every time.
+
+SegmentIndex keeps segment starts, ends, loudnesses and pitches in sorted NumPy arrays,
+built once per song, and answers overlap and loudness queries with searchsorted.
+PitchIndex uses it to find beats of a given pitch once per pool of beats,
+for all twelve pitch classes at a time - so searching for samples is a dict lookup.
+
+by Peter Sobot <hi@petersobot.com>
+"""
+import echonest.audio as audio
+import numpy
+
+class SegmentIndex():
+    def __init__(self, segments):
+        """
+            Indexes the start, end, loudness_max and pitches of a list of segments
+            (a.k.a: song.analysis.segments), which are assumed to be in order and not overlap.
+        """
+        self.segments = segments
+        self.starts = numpy.array([s.start for s in segments], dtype=numpy.float64)
+        self.ends = numpy.array([s.start + s.duration for s in segments], dtype=numpy.float64)
+        self.loudnesses = numpy.array([s.loudness_max for s in segments], dtype=numpy.float64)
+        self.pitches = numpy.array([s.pitches for s in segments], dtype=numpy.float64).reshape((len(segments), 12))
+        self.cumulative = numpy.concatenate(([0.0], numpy.cumsum(self.loudnesses)))
+
+    def __len__(self):
+        return len(self.segments)
+
+    def bounds(self, starts, ends):
+        """
+            Index ranges [lo, hi) of the segments that overlap each (start, end) range.
+            Works on single values or arrays of them.
+        """
+        return numpy.searchsorted(self.ends, starts, 'right'), numpy.searchsorted(self.starts, ends, 'left')
+
+    def overlapping(self, start, end):
+        """
+            Same as segments.that(overlap_range(start, end)), as a list.
+        """
+        lo, hi = self.bounds(start, end)
+        return self.segments[lo:hi] if hi > lo else []
+
+    def loudness(self, start, end):
+        """
+            Average loudness_max of the segments overlapping a range, or None if there aren't any.
+        """
+        loud = self.loudness_for_ranges([start], [end])[0]
+        return None if numpy.isnan(loud) else float(loud)
+
+    def loudness_for_ranges(self, starts, ends):
+        """
+            Average loudness_max of the segments overlapping each of a list of ranges, all at once.
+            Ranges without any segments get NaN.
+        """
+        lo, hi = self.bounds(numpy.asarray(starts, dtype=numpy.float64), numpy.asarray(ends, dtype=numpy.float64))
+        counts = numpy.maximum(hi - lo, 0)
+        totals = self.cumulative[numpy.maximum(hi, lo)] - self.cumulative[lo]
+        result = numpy.empty(len(counts))
+        result.fill(numpy.nan)
+        found = counts > 0
+        result[found] = totals[found] / counts[found]
+        return result
+
+class PitchIndex():
+    def __init__(self, index):
+        """
+            Finds pitched samples among the segments of a SegmentIndex.
+        """
+        self.segments = index.segments
+        self.starts = index.starts
+        self.ends = index.ends
+        #   Same test as have_pitch_max: ties count as the maximum for every tied pitch.
+        if len(index):
+            self.dominant = index.pitches == index.pitches.max(axis=1).reshape((-1, 1))
+        else:
+            self.dominant = numpy.zeros((0, 12), dtype=bool)
+        self.pools = {}
+
+    def candidates(self, pool, target):
+        """
+            The beats (or bars) of a section that samples are chosen from.
+            Pools that aren't sections (i.e.: a list of bars or segments) are used as-is.
+        """
+        if target == "bars":
+            return list(pool.children())
+        try:
+            return [b for x in pool.children() for b in x.children()]
+        except AttributeError:
+            return list(pool)
+
+    def build(self, pool, target):
+        """
+            Finds the matching quanta in a pool for all 12 pitch classes at once.
+        """
+        quanta = self.candidates(pool, target)
+        result = [audio.AudioQuantumList() for pitch in xrange(12)]
+        if not quanta or not len(self.segments):
+            return result
+
+        starts = numpy.array([q.start for q in quanta], dtype=numpy.float64)
+        ends = starts + numpy.array([q.duration for q in quanta], dtype=numpy.float64)
+        order = numpy.argsort(starts, kind='mergesort')
+        sorted_starts = starts[order]
+
+        #   overlap_starts_of: a segment qualifies if some quantum starts within it.
+        covers = numpy.searchsorted(sorted_starts, self.ends, 'left') > numpy.searchsorted(sorted_starts, self.starts, 'left')
+
+        for pitch in xrange(12):
+            segment_ends = numpy.sort(self.ends[covers & self.dominant[:, pitch]])
+            if not len(segment_ends):
+                continue
+            #   overlap_ends_of: a quantum qualifies if one of those segments ends within it.
+            hits = numpy.searchsorted(segment_ends, ends, 'right') > numpy.searchsorted(segment_ends, starts, 'right')
+            result[pitch].extend([quanta[i] for i in numpy.flatnonzero(hits)])
+        return result
+
+    def get(self, pool, pitch, target="beats"):
+        """
+            All quanta in a section (or other pool) that overlap the end of a segment of the given pitch,
+            where that segment also overlaps the start of some quantum in the pool.
+        """
+        key = (id(pool), target)
+        if not key in self.pools:
+            self.pools[key] = (pool, self.build(pool, target))   #   Keep the pool alive so its id() stays unique
+        return self.pools[key][1][pitch % 12]
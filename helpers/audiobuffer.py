@@ -0,0 +1,161 @@
+"""
+audiobuffer.py
+
+Zero-copy helpers for the sample arrays inside echonest's AudioData objects.
+AudioData(ndarray=...) always copies its input, and the Remix API's channel and
+slicing utilities go through Python lists or numpy.append - fine for one-offs,
+but these run for every bar of every remix. Everything here returns views where
+it can, and makes at most one preallocated copy where it can't.
+
+by Peter Sobot <hi@petersobot.com>
+"""
+from subprocess import check_call, Popen, PIPE, CalledProcessError
+import echonest.audio as audio
+import numpy, os
+
+def view(data, sampleRate=44100):
+    """
+        Wraps an existing sample array in an AudioData without copying it.
+    """
+    ad = audio.AudioData(sampleRate=sampleRate, numChannels=(1 if data.ndim == 1 else data.shape[1]), defer=True, verbose=False)
+    ad.data = data
+    ad.endindex = len(data)
+    return ad
+
+def frames(audiodata):
+    """
+        The valid part of an AudioData's sample array. (AudioData buffers can be longer than their contents.)
+    """
+    return audiodata.data[:audiodata.endindex] if audiodata.endindex else audiodata.data
+
+def stereo(audiodata):
+    """
+        Returns a two-channel version of an AudioData.
+        Mono audio is upmixed by broadcasting into one preallocated int16 array;
+        audio that's already stereo is returned as-is.
+    """
+    data = frames(audiodata)
+    if data.ndim > 1 and data.shape[1] == 2:
+        return audiodata
+    out = numpy.empty((len(data), 2), dtype=data.dtype)
+    out[:] = data.reshape((len(data), -1))[:, :1]
+    return view(out, audiodata.sampleRate)
+
+def silence(length, numChannels=2, sampleRate=44100):
+    return view(numpy.zeros((length, numChannels), dtype=numpy.int16), sampleRate)
+
+scratch = {}    #   Reusable float32 buffers, by name and channel count, per process.
+
+def accumulator(name, length, numChannels):
+    """
+        Returns a float32 (length, numChannels) view of one of this process's scratch buffers,
+        growing it if needed. Contents are undefined, and only valid until the next call!
+    """
+    buf = scratch.get((name, numChannels))
+    if buf is None or len(buf) < length:
+        buf = scratch[(name, numChannels)] = numpy.empty((length, numChannels), dtype=numpy.float32)
+    return buf[:length]
+
+def mix(sources, length=None, numChannels=2):
+    """
+        Mixes any number of (AudioData, gain) pairs into one new int16 AudioData.
+        The output is `length` samples long (default: the length of the first source);
+        shorter sources are treated as silence past their end, longer ones are truncated.
+
+        Everything is accumulated in float32 scratch space and clipped once at the end,
+        so the only allocation per call is the int16 output - and loud sources
+        saturate instead of wrapping around.
+    """
+    if length is None:
+        length = len(frames(sources[0][0]))
+    acc = accumulator('mix', length, numChannels)
+    acc.fill(0)
+    temp = accumulator('gain', length, numChannels)
+    sampleRate = sources[0][0].sampleRate if sources else 44100
+    for audiodata, gain in sources:
+        data = frames(audiodata)
+        n = min(len(data), length)
+        if not n or not gain:
+            continue
+        data = data[:n].reshape((n, -1))    #   (n,) and (n, 1) both broadcast across channels
+        numpy.multiply(data, float(gain), out=temp[:n], casting='unsafe')
+        numpy.add(acc[:n], temp[:n], out=acc[:n])
+    numpy.clip(acc, -32768, 32767, out=acc)
+    out = numpy.empty((length, numChannels), dtype=numpy.int16)
+    out[:] = acc
+    return view(out, sampleRate)
+
+def decode(filename, destination, sampleRate=44100, numChannels=2):
+    """
+        Decodes any audio file to raw int16 PCM at destination (with en-ffmpeg, like the Remix API does),
+        and returns it as a read-only numpy memmap - so it's paged in from disk as it's used,
+        instead of the whole song sitting in memory.
+    """
+    devnull = open(os.devnull, 'w')
+    try:
+        check_call(['en-ffmpeg', '-y', '-i', filename, '-f', 's16le', '-ac', str(numChannels), '-ar', str(sampleRate), destination], stdout=devnull, stderr=devnull)
+    finally:
+        devnull.close()
+    length = os.path.getsize(destination) / (2 * numChannels)
+    if not length:
+        raise ValueError("No audio could be decoded from %s." % filename)
+    return numpy.memmap(destination, dtype=numpy.int16, mode='r', shape=(length, numChannels))
+
+def stream(filename, seconds, sampleRate=44100, numChannels=2):
+    """
+        Decodes any audio file with en-ffmpeg through a pipe, yielding its samples
+        as int16 arrays of (at most) the given number of seconds each -
+        so no more than one chunk of the song is ever in memory, however long it is.
+    """
+    devnull = open(os.devnull, 'w')
+    process = Popen(['en-ffmpeg', '-i', filename, '-f', 's16le', '-ac', str(numChannels), '-ar', str(sampleRate), '-'], stdout=PIPE, stderr=devnull)
+    frame = 2 * numChannels
+    size = int(seconds * sampleRate) * frame
+    leftover = ''
+    decoded = 0
+    complete = False
+    try:
+        while True:
+            data = leftover + process.stdout.read(size)
+            if len(data) < frame:
+                break
+            usable = len(data) - len(data) % frame
+            leftover = data[usable:]
+            decoded += usable / frame
+            yield numpy.frombuffer(data[:usable], dtype=numpy.int16).reshape((-1, numChannels))
+        complete = True
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.terminate()
+        process.wait()
+        devnull.close()
+    #   A decode that fails partway through still ends the stream, so check it got to the end
+    if complete and process.returncode:
+        raise CalledProcessError(process.returncode, 'en-ffmpeg')
+    if not decoded:
+        raise ValueError("No audio could be decoded from %s." % filename)
+
+def attach(audiodata, data, sampleRate=44100):
+    """
+        Points an existing (i.e.: deferred) AudioData at a sample array, without copying it.
+    """
+    audiodata.data = data
+    audiodata.endindex = len(data)
+    audiodata.sampleRate = sampleRate
+    audiodata.numChannels = 1 if data.ndim == 1 else data.shape[1]
+    audiodata.duration = float(len(data)) / sampleRate
+    return audiodata
+
+def bounds(audiodata, quanta):
+    """
+        (start, end) sample indices of each AudioQuantum, the same way AudioData indexes them.
+    """
+    sampleRate = audiodata.sampleRate
+    length = len(frames(audiodata))
+    result = []
+    for q in quanta:
+        start = min(int(q.start * sampleRate), length)
+        end = min(int((q.start + q.duration) * sampleRate), length)
+        result.append((start, max(start, end)))
+    return result
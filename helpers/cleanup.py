@@ -1,4 +1,4 @@
-import config, os, database, traceback, time
+import config, os, shutil, database, traceback, time
 
 class Cleanup():
     directories = ['tmp', 'uploads', 'static/songs']
@@ -12,8 +12,25 @@ class Cleanup():
         self.log = log
         self.remixQueue = remixQueue
 
+    def remove(self, p):
+        """
+            Removes a file, or a whole directory (i.e.: a remix's workspace).
+        """
+        if os.path.isdir(p) and not os.path.islink(p):
+            shutil.rmtree(p)
+        else:
+            os.remove(p)
+
+    def scratch(self):
+        """
+            Directories that remixes' files are kept in - including the tmpfs that workspaces go on, if any.
+        """
+        if config.scratch_tmpfs_directory:
+            return self.directories + [config.scratch_tmpfs_directory]
+        return self.directories
+
     def all(self):
-        for d in self.directories:
+        for d in self.scratch():
             if not os.path.exists(d):
                 self.log.info("\t\Creating directory %s..." % d)
                 os.mkdir(d)
@@ -24,7 +41,7 @@ class Cleanup():
                         p = os.path.join(d, f)
                         self.log.info("\t\t\tRemoving %s..." % p)
                         try:
-                            os.remove(p)
+                            self.remove(p)
                         except:
                             self.log.warning("Failed to remove %s:\n%s" % (p, traceback.format_exc()))
                             pass
@@ -37,12 +54,14 @@ class Cleanup():
             if 'time' in remixer and remixer['time'] > (time.time() - config.cleanup_timeout):
                 continue
             self.log.info("\tClearing: %s" % uid)
-            for d in self.directories:
+            for d in self.scratch():
+                if not os.path.isdir(d):
+                    continue
                 for f in os.listdir(d):
                     if uid in f and not any([k in f for k in self.keep]):
                         p = os.path.join(d, f)
                         self.log.info("\t\tRemoving %s..." % f)
-                        os.remove(p)
+                        self.remove(p)
             del self.remixQueue.finished[uid]
         self.thumbnails()
 
@@ -0,0 +1,144 @@
+"""
+diskcache.py
+
+Size-bounded, least-recently-used caches of files on disk.
+File modification times are used as the LRU clock: every hit touches its file,
+and when the cache grows past its byte limit, the stalest files are deleted first.
+Entries are written to a temporary file and renamed into place, so concurrent
+remix processes can safely share one cache directory.
+
+by Peter Sobot <hi@petersobot.com>
+"""
+import os, cPickle, hashlib, logging, traceback, config
+
+def filehash(filename):
+    """
+        MD5 of a file's contents, in the same format as Track.hash.
+    """
+    h = hashlib.md5()
+    f = open(filename, 'rb')
+    for chunk in iter(lambda: f.read(1 << 20), ''):
+        h.update(chunk)
+    f.close()
+    return h.hexdigest()
+
+class DiskCache():
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, key, ext=''):
+        return os.path.join(self.directory, "%s%s" % (key, ext))
+
+    def touch(self, filename):
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+
+    def commit(self, temp, filename):
+        """
+            Atomically moves a finished temporary file into the cache, then trims the cache.
+        """
+        os.rename(temp, filename)
+        self.evict()
+
+    def mkdir(self):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass    #   Another process got there first
+
+    def tempfile(self, filename):
+        self.mkdir()
+        return "%s.%s.tmp" % (filename, os.getpid())
+
+    def entries(self):
+        """
+            Returns (mtime, size, path) for every file in the cache.
+        """
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for f in os.listdir(self.directory):
+            p = os.path.join(self.directory, f)
+            try:
+                s = os.stat(p)
+                entries.append((s.st_mtime, s.st_size, p))
+            except OSError:
+                pass    #   Evicted by somebody else while we were looking
+        return entries
+
+    def evict(self):
+        """
+            Deletes the least recently used files until the cache fits in max_bytes.
+        """
+        entries = sorted(self.entries())
+        total = sum([size for mtime, size, p in entries])
+        for mtime, size, p in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(p)
+                total -= size
+            except OSError:
+                pass
+
+class AnalysisCache(DiskCache):
+    """
+        Echo Nest analyses (beats, bars, sections, segments, key, tempo, time signature...),
+        pickled and keyed by the MD5 of the uploaded file.
+    """
+    lazy = ['bars', 'beats', 'sections', 'segments', 'tatums']
+
+    def __init__(self, directory=None, max_bytes=None):
+        DiskCache.__init__(
+            self,
+            directory or config.analysis_cache_directory,
+            max_bytes if max_bytes is not None else config.analysis_cache_size
+        )
+
+    def get(self, key):
+        """
+            Returns the cached AudioAnalysis for this key, or None. (Its source is not set.)
+        """
+        filename = self.path(key, '.analysis')
+        if not os.path.isfile(filename):
+            return None
+        try:
+            f = open(filename, 'rb')
+            analysis = cPickle.load(f)
+            f.close()
+        except:
+            logging.getLogger().warning("Discarding unreadable analysis %s:\n%s" % (filename, traceback.format_exc()))
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+            return None
+        self.touch(filename)
+        return analysis
+
+    def put(self, key, analysis):
+        filename = self.path(key, '.analysis')
+        temp = self.tempfile(filename)
+
+        #   Make sure all lazily-computed quanta are in the pickle,
+        #   and leave the audio itself (the analysis' source) out of it.
+        for attr in self.lazy:
+            getattr(analysis, attr, None)
+        source = analysis.source
+        analysis.source = None
+        try:
+            f = open(temp, 'wb')
+            try:
+                cPickle.dump(analysis, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+        except:
+            os.unlink(temp)
+            raise
+        finally:
+            analysis.source = source
+        self.commit(temp, filename)
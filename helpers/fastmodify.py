@@ -2,37 +2,67 @@
 fastmodify.py
 
 Provides similar functionality to echonest.Modify, but faster and lighter.
-Requires soundstretch command-line binary to be installed.
+Tempo shifting is done in-process by helpers.timestretch (WSOLA) by default.
+Set time_stretch_engine to "soundstretch" in config.yml to fall back to the
+soundstretch command-line binary, which must then be installed.
 
 Based on code by Ben Lacker on 2009-06-12.
 Modified by Peter Sobot for speed on 2011-08-12
 """
 from echonest.audio import *
-import uuid, os
+from helpers import timestretch
+import uuid, os, config
 
 class FastModify():
-    def processAudio( self, ad, arg, tempdir="tmp/" ):
-        if not os.access( tempdir, os.W_OK ):
-            tempdir = './'
+    def __init__(self, engine=None, workspace=None):
+        """
+            Engine is either "wsola" (in-process) or "soundstretch" (subprocess).
+            Defaults to the time_stretch_engine config variable.
+            Soundstretch's temp files go in workspace (a helpers.workspace.Workspace) if given, or tmp/.
+        """
+        self.engine = engine or config.time_stretch_engine
+        self.workspace = workspace
+
+    def tempfile( self, name, size ):
+        if self.workspace:
+            return self.workspace.path( name, size )
+        return os.path.join( 'tmp/' if os.access( 'tmp/', os.W_OK ) else './', name )
+
+    def processAudio( self, ad, arg, ratio=1.0 ):
         u = str( uuid.uuid1() )
-        ad.encode( '%s%s.wav' % ( tempdir, u ) )
-        process = subprocess.Popen(   ['soundstretch', '%s%s.wav' % ( tempdir, u ), '%s%s.out.wav' % ( tempdir, u ), arg],
+        size = ad.data.nbytes if ad.data is not None else 0
+        infile = self.tempfile( '%s.wav' % u, size )
+        outfile = self.tempfile( '%s.out.wav' % u, int( size / ratio ) )
+        ad.encode( infile )
+        process = subprocess.Popen(   ['soundstretch', infile, outfile, arg],
                             stdin=None,
                             stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE
                         )
         process.wait()
-        os.unlink( '%s%s.wav' % ( tempdir, u ) )
-        ad = AudioData( '%s%s.out.wav' % ( tempdir, u ), verbose=False )
-        os.unlink( '%s%s.out.wav' % ( tempdir, u ) )
+        os.unlink( infile )
+        if self.workspace:
+            self.workspace.release( infile )
+        ad = AudioData( outfile, verbose=False )
+        os.unlink( outfile )
+        if self.workspace:
+            self.workspace.release( outfile )
         return ad
 
+    def stretchAudio(self, ad, ratio):
+        """
+            Shifts tempo in memory, straight from the AudioData's sample array.
+        """
+        data = timestretch.stretch(ad.data[:ad.endindex] if ad.endindex else ad.data, ratio)
+        return AudioData(ndarray=data, sampleRate=ad.sampleRate, numChannels=ad.numChannels, defer=False, verbose=False)
+
     def shiftTempo(self, audio_data, ratio):
         if not isinstance(audio_data, AudioData):
             raise TypeError('First argument must be an AudioData object.')
         if not (isinstance(ratio, int) or isinstance(ratio, float)):
             raise ValueError('Ratio must be an int or float.')
-        if (ratio < 0) or (ratio > 10):
-            raise ValueError('Ratio must be between 0 and 10.')
-        return self.processAudio(audio_data, '-tempo=%s' % float((ratio-1)*100))
-
+        if (ratio <= 0) or (ratio > 10):
+            raise ValueError('Ratio must be more than 0, and at most 10.')
+        if self.engine == "soundstretch":
+            return self.processAudio(audio_data, '-tempo=%s' % float((ratio-1)*100), ratio)
+        return self.stretchAudio(audio_data, ratio)
@@ -0,0 +1,96 @@
+"""
+lru.py
+
+An in-memory, least-recently-used cache bounded by the total size of its values, in bytes.
+Used to keep stretched pieces of a song around between sections of a remix, so beats that
+recur aren't stretched again - without letting a long song eat all of a worker's memory.
+
+by Peter Sobot <hi@petersobot.com>
+"""
+from collections import OrderedDict
+
+def combine(stats):
+    """
+        One set of stats for several caches' stats() - i.e.: one cache per process.
+        Lookups are added up; sizes are those of the fullest cache.
+    """
+    combined = {'hits': 0, 'misses': 0, 'evictions': 0, 'entries': 0, 'bytes': 0, 'max_bytes': 0}
+    for s in stats:
+        for k in ['hits', 'misses', 'evictions']:
+            combined[k] += s[k]
+        for k in ['entries', 'bytes', 'max_bytes']:
+            combined[k] = max(combined[k], s[k])
+    return combined
+
+class LRUCache():
+    def __init__(self, max_bytes):
+        """
+            Values should be NumPy arrays (or anything else with an nbytes attribute).
+            Anything bigger than max_bytes on its own isn't kept at all.
+        """
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        """
+            Membership tests count as lookups: the Renderer checks before it reads.
+        """
+        if key in self.items:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def __getitem__(self, key):
+        value = self.items.pop(key)
+        self.items[key] = value     #   Most recently used go last
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self.items:
+            self.bytes -= self.size(self.items.pop(key))
+        size = self.size(value)
+        if size > self.max_bytes:
+            return
+        self.items[key] = value
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            oldest, evicted = self.items.popitem(last=False)
+            self.bytes -= self.size(evicted)
+            self.evictions += 1
+
+    def size(self, value):
+        return getattr(value, 'nbytes', 0)
+
+    def clear(self):
+        self.items.clear()
+        self.bytes = 0
+
+    def resetCounts(self):
+        """
+            Starts counting hits, misses and evictions from zero - i.e.: before forking, so
+            each process' stats only count its own lookups. Cached values are kept.
+        """
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        """
+            Hit and miss counts, for tuning max_bytes.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.items),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+        }
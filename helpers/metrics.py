@@ -0,0 +1,102 @@
+"""
+metrics.py
+
+Counters and histograms of what the remix queue has been up to, kept in the server process,
+and rendered in Prometheus' text exposition format for /monitor/metrics.
+
+by Peter Sobot <hi@petersobot.com>
+"""
+import math
+
+#   Upper bounds of histogram buckets, in seconds
+BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200]
+
+class Histogram():
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+            (upper bound, number of observations at or below it) for each bucket, as Prometheus expects.
+        """
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+def labels(values):
+    if not values:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in sorted(values.iteritems())])
+
+def number(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if math.isnan(value):
+            return 'NaN'
+        return repr(value)
+    return str(value)
+
+class Metrics():
+    """
+        A registry of named metrics, each with any number of label combinations.
+    """
+    def __init__(self, prefix='wubmachine_'):
+        self.prefix = prefix
+        self.help = {}
+        self.types = {}
+        self.values = {}    #   name -> {labels tuple: Histogram or number}
+
+    def describe(self, name, kind, text):
+        self.types[name] = kind
+        self.help[name] = text
+        self.values.setdefault(name, {})
+
+    def key(self, values):
+        return tuple(sorted(values.iteritems()))
+
+    def observe(self, name, value, **values):
+        series = self.values.setdefault(name, {})
+        key = self.key(values)
+        if not key in series:
+            series[key] = Histogram()
+        series[key].observe(value)
+
+    def increment(self, name, by=1, **values):
+        series = self.values.setdefault(name, {})
+        key = self.key(values)
+        series[key] = series.get(key, 0) + by
+
+    def set(self, name, value, **values):
+        self.values.setdefault(name, {})[self.key(values)] = value
+
+    def render(self):
+        lines = []
+        for name in sorted(self.values):
+            full = self.prefix + name
+            if name in self.help:
+                lines.append('# HELP %s %s' % (full, self.help[name]))
+            lines.append('# TYPE %s %s' % (full, self.types.get(name, 'untyped')))
+            for key, value in sorted(self.values[name].items()):
+                values = dict(key)
+                if isinstance(value, Histogram):
+                    for bound, count in value.cumulative():
+                        lines.append('%s_bucket%s %s' % (full, labels(dict(values, le=number(float(bound)))), count))
+                    lines.append('%s_bucket%s %s' % (full, labels(dict(values, le='+Inf')), value.count))
+                    lines.append('%s_sum%s %s' % (full, labels(values), number(value.sum)))
+                    lines.append('%s_count%s %s' % (full, labels(values), value.count))
+                else:
+                    lines.append('%s%s %s' % (full, labels(values), number(value)))
+        return '\n'.join(lines) + '\n'
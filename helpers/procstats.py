@@ -0,0 +1,145 @@
+"""
+procstats.py
+
+Reads what a remix process (and everything it spawns) is costing, from /proc.
+The server samples each running remix's process every few seconds with a Sampler,
+and keeps the totals: CPU seconds, peak RSS, bytes read and written, and the commands
+it started along the way (lame, soundstretch, shntool, en-ffmpeg...).
+
+Pooled workers outlive their remixes, so everything is counted from where the worker
+was when the remix started. On systems without /proc, samples are just empty.
+
+by Peter Sobot <hi@petersobot.com>
+"""
+import os
+
+try:
+    CLOCK_TICKS = float(os.sysconf('SC_CLK_TCK'))
+except (ValueError, OSError, AttributeError):
+    CLOCK_TICKS = 100.0
+try:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (ValueError, OSError, AttributeError):
+    PAGE_SIZE = 4096
+
+def stat(pid):
+    """
+        (command, parent pid, CPU seconds including reaped children, RSS in bytes) of a process, or None if it's gone.
+    """
+    try:
+        line = open('/proc/%s/stat' % pid).read()
+    except (IOError, OSError):
+        return None
+    #   The command is in parentheses, and may itself contain spaces or parentheses
+    command = line[line.index('(') + 1:line.rindex(')')]
+    fields = line[line.rindex(')') + 2:].split()
+    utime, stime, cutime, cstime = [int(f) for f in fields[11:15]]
+    return command, int(fields[1]), (utime + stime + cutime + cstime) / CLOCK_TICKS, int(fields[21]) * PAGE_SIZE
+
+def highwater(pid):
+    """
+        Peak RSS of a process over its whole life, in bytes (VmHWM), or 0 if it can't be read.
+    """
+    try:
+        for line in open('/proc/%s/status' % pid):
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return 0
+
+def io(pid):
+    """
+        (bytes read, bytes written) from storage by a process and its reaped children.
+        /proc/<pid>/io is only readable by the process' owner, so this is (0, 0) if it can't be read.
+    """
+    counters = {}
+    try:
+        for line in open('/proc/%s/io' % pid):
+            key, value = line.split(':')
+            counters[key] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return counters.get('read_bytes', 0), counters.get('write_bytes', 0)
+
+def children():
+    """
+        Map of parent pid to a list of its children's pids, for every process on the system.
+    """
+    tree = {}
+    try:
+        pids = [p for p in os.listdir('/proc') if p.isdigit()]
+    except OSError:
+        return tree
+    for pid in pids:
+        s = stat(pid)
+        if s:
+            tree.setdefault(s[1], []).append(int(pid))
+    return tree
+
+def descendants(pid):
+    tree = children()
+    found = []
+    stack = list(tree.get(pid, []))
+    while stack:
+        child = stack.pop()
+        found.append(child)
+        stack.extend(tree.get(child, []))
+    return found
+
+class Sampler():
+    """
+        Totals for one remix, running in process pid. Call sample() every so often while it runs,
+        and once more just before the process is reaped; totals() are what's been seen so far.
+    """
+    def __init__(self, pid):
+        self.pid = pid
+        self.samples = 0
+        self.cpu = 0.0
+        self.peak_rss = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.commands = {}      #   command name -> number of processes of it spawned
+        self.seen = set()       #   (pid, command) of every descendant seen, so each is counted once
+
+        s = stat(pid)
+        self.baseCpu = s[2] if s else 0.0
+        self.baseRead, self.baseWrite = io(pid)
+        self.baseHighwater = highwater(pid)
+
+    def sample(self):
+        s = stat(self.pid)
+        if not s:
+            return
+        self.samples += 1
+        cpu, rss = s[2], s[3]
+        live = {}
+        for child in descendants(self.pid):
+            c = stat(child)
+            if not c:
+                continue
+            live[child] = c[2]
+            rss += c[3]
+            if not (child, c[0]) in self.seen:
+                self.seen.add((child, c[0]))
+                self.commands[c[0]] = self.commands.get(c[0], 0) + 1
+
+        #   Children that have been reaped are counted in their parent's CPU time from then on
+        self.cpu = max(self.cpu, cpu - self.baseCpu + sum(live.values()))
+        self.peak_rss = max(self.peak_rss, rss)
+        hwm = highwater(self.pid)
+        if hwm > self.baseHighwater:    #   A new peak since the remix started, which sampling might have missed
+            self.peak_rss = max(self.peak_rss, hwm)
+        read, write = io(self.pid)
+        self.read_bytes = max(self.read_bytes, read - self.baseRead)
+        self.write_bytes = max(self.write_bytes, write - self.baseWrite)
+
+    def totals(self):
+        return {
+            'cpu': round(self.cpu, 3),
+            'peak_rss': self.peak_rss,
+            'read_bytes': self.read_bytes,
+            'write_bytes': self.write_bytes,
+            'commands': dict(self.commands),
+            'samples': self.samples,
+        }
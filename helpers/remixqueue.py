@@ -1,11 +1,15 @@
-import config, os, time, database, traceback, logging
+import config, os, time, json, database, traceback, logging
+import tornado.ioloop
 from helpers.web import ordinal
-from datetime import datetime, timedelta
+from helpers.resultcache import ResultCache, CachedRemixer
+from helpers.metrics import Metrics
+from datetime import datetime
 
 class RemixQueue():
     def __init__(self, monitor):
         self.log = logging.getLogger()
         self.monitor_callback = monitor.update
+        self.ioloop = tornado.ioloop.IOLoop.instance()     #   Remixers report progress on this loop
 
         self.remixers = {}
         self.finished = {}
@@ -16,7 +20,20 @@ class RemixQueue():
         self.queue    = []
         self.running  = []
 
-    def add(self, uid, ext, remixer, _user_callback, done_callback):
+        self.results = ResultCache()
+        self.cacheHits = 0
+        self.pool = None    #   WorkerPool, if remixes should run in pre-forked workers
+
+        self.metrics = Metrics()
+        self.metrics.describe('remixes_total', 'counter', "Remixes finished, by style and status (done, failed, cached or removed).")
+        self.metrics.describe('remix_queue_wait_seconds', 'histogram', "Time remixes spent waiting in the queue before starting.")
+        self.metrics.describe('remix_run_seconds', 'histogram', "Time remixes spent running.")
+        self.metrics.describe('remix_stage_seconds', 'histogram', "Time remixes spent in each stage, as timed by the remix process.")
+        self.metrics.describe('queue_waiting', 'gauge', "Remixes waiting to start.")
+        self.metrics.describe('queue_running', 'gauge', "Remixes running.")
+        self.metrics.describe('result_cache_hits', 'counter', "Remixes served from the result cache.")
+
+    def add(self, uid, ext, remixer, _user_callback, done_callback, hash=None):
         self.log.debug("Adding remixer %s to queue..." % uid)
         if uid in self.remixers:
             raise Exception("Song already receieved!")
@@ -25,13 +42,21 @@ class RemixQueue():
         outfile = os.path.join("static/songs/", "%s.mp3" % uid)
 
         user_callback = lambda data: _user_callback(uid, data)
-        self.remixers[uid] = remixer(self, str(infile), str(outfile), [self.monitor_callback, user_callback])
+        entry = self.results.get(hash, remixer) if hash else None
+        if entry:
+            self.log.info("Remix of %s found in result cache for %s." % (hash, uid))
+            self.remixers[uid] = CachedRemixer(self, str(infile), str(outfile), [self.monitor_callback, user_callback], entry, self.results)
+        else:
+            self.remixers[uid] = remixer(self, str(infile), str(outfile), [self.monitor_callback, user_callback])
+            self.remixers[uid].pool = self.pool
+        self.remixers[uid].style = remixer
+        self.remixers[uid].hash = hash
         self.watching[uid] = user_callback
         self.cleanups[uid] = done_callback
         self.queue.append(uid)
 
     def updateTrack(self, uid, tag):
-        # This may be called from another thread: let's use a unique DB connection.
+        # This is called from remix processes: let's use a unique DB connection.
         self.log.info("Updating track %s..." % uid)
         db = database.Session()
         try:
@@ -54,7 +79,8 @@ class RemixQueue():
         try:
             if not uid in self.remixers:
                 return False
-            if self.remixers[uid].isAlive():
+            remixer = self.remixers[uid]
+            if remixer.isAlive():
                 self.stop(uid)
             del self.remixers[uid]
             if not final:
@@ -75,10 +101,27 @@ class RemixQueue():
                     event.detail = final.get('debug')
                 else:
                     event.success = True
+                    if final.get('cached'):
+                        event.detail = 'cached'
+                if getattr(remixer, 'resources', None):
+                    event.resources = json.dumps(remixer.resources)
                 db.commit()
             except:
                 db.rollback()
                 self.log.error("DB error when finishing %s from queue:\n%s" % (uid, traceback.format_exc()))
+
+            if final.get('stats'):
+                self.log.info("Remixer %s stats: %s" % (uid, final['stats']))
+            if getattr(remixer, 'resources', None):
+                self.log.info("Remixer %s used: %s" % (uid, remixer.resources))
+            self.record(remixer, final)
+            if final.get('cached'):
+                self.cacheHits += 1
+            elif final['status'] is not -1 and remixer.hash:
+                try:
+                    self.results.put(remixer.hash, remixer.style, final)
+                except:
+                    self.log.error("Could not store %s in result cache:\n%s" % (uid, traceback.format_exc()))
             self.notifyWatchers()
             self.monitor_callback(uid)
             self.log.debug("Remixer %s finished! Calling next()..." % uid)
@@ -86,11 +129,40 @@ class RemixQueue():
         except:
             self.log.error("Could not finish %s from queue:\n %s" % (uid, traceback.format_exc()))           
 
+    def record(self, remixer, final, status=None):
+        """
+            Adds a finished (or removed) remix to the queue's metrics.
+            Stage timings of cached results are from the original remix, so they're left out.
+        """
+        try:
+            style = getattr(remixer.style, '__name__', str(remixer.style))
+            if not status:
+                status = 'cached' if final.get('cached') else ('failed' if final.get('status') is -1 else 'done')
+            self.metrics.increment('remixes_total', style=style, status=status)
+            if remixer.started:
+                self.metrics.observe('remix_queue_wait_seconds', remixer.started - remixer.added, style=style)
+                self.metrics.observe('remix_run_seconds', time.time() - remixer.started, style=style)
+            if not final.get('cached'):
+                for stage, seconds in (final.get('timings') or {}).iteritems():
+                    self.metrics.observe('remix_stage_seconds', seconds, style=style, stage=stage)
+        except:
+            self.log.error("Could not record metrics for %s:\n%s" % (remixer.uid, traceback.format_exc()))
+
+    def exposition(self):
+        """
+            The queue's metrics, in Prometheus' text format.
+        """
+        self.metrics.set('queue_waiting', len(self.queue))
+        self.metrics.set('queue_running', len(self.running))
+        self.metrics.set('result_cache_hits', self.cacheHits)
+        return self.metrics.render()
+
     def remove(self, uid):
         try:
             if uid in self.remixers:
                 if self.remixers[uid].isAlive():
                     self.stop(uid)
+                self.record(self.remixers[uid], {}, 'removed')
                 del self.remixers[uid]
                 final = { 'status': -1, 'text': "Sorry, this remix is taking too long. Try again later!", 'progress': 0, 'uid': uid, 'time': time.time() }
                 if uid in self.watching:
@@ -144,6 +216,10 @@ class RemixQueue():
         self.monitor_callback(uid)
       
 
+    def isCached(self, uid):
+        # Cached remixes finish instantly, so they don't need to wait for a free slot.
+        return isinstance(self.remixers.get(uid), CachedRemixer)
+
     def stop(self, uid):
         if uid in self.remixers and self.remixers[uid].isAlive():
             self.log.info("Stopping thread %s..." % uid)
@@ -167,8 +243,12 @@ class RemixQueue():
         return { 'status': 0, 'text': text, 'progress': 0, 'uid': uid, 'time': time.time() }
 
     def next(self):
+        """
+            Starts the first watched remix in the queue that can start now: a cached one always can,
+            but a real one only while there's room for it under maximum_concurrent_remixes.
+        """
         for uid in self.queue:
-            if uid in self.watching:
+            if uid in self.watching and (self.isAvailable() or self.isCached(uid)):
                 try:
                     self.start(uid)
                     self.log.info("Started remixer %s..." % uid)
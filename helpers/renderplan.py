@@ -0,0 +1,246 @@
+"""
+renderplan.py
+
+A compact, declarative description of how to render a stretch of audio, and the one
+renderer that turns it into samples.
+
+Remixers used to build AudioQuantumLists, call getpieces/assemble, stretch, mix and
+pad in their own imperative code. Now they describe what they want as a RenderPlan:
+an array of events, each of which reads a run of samples from a source (the original
+song, or one of the remixer's samples), optionally stretches it, and mixes it in at
+some position of the output with some gain. The Renderer executes plans into one
+preallocated buffer, in chunks if asked, so there's a single place to optimise,
+cache and parallelise rendering - and plans can be dumped as text, to be logged or diffed.
+
+by Peter Sobot <hi@petersobot.com>
+"""
+from helpers import audiobuffer
+import numpy
+
+ORIGINAL = 0    #   Source number of the song being remixed. Samples are numbered from 1.
+
+event = numpy.dtype([
+    ('source',  numpy.int32),   #   ORIGINAL, or the index of a sample in RenderPlan.sources
+    ('offset',  numpy.int64),   #   first sample to read from the source
+    ('length',  numpy.int64),   #   number of samples to read from the source (-1: to the end)
+    ('ratio',   numpy.float64), #   tempo ratio to stretch by (1: no stretching)
+    ('gain',    numpy.float32),
+    ('start',   numpy.int64),   #   where to mix the result into the output
+    ('limit',   numpy.int64),   #   most samples of the result to use (-1: all of them)
+    ('group',   numpy.int32),   #   events in the same group (>= 0) are read back to back and stretched as one
+])
+
+class RenderPlan():
+    def __init__(self, length=0):
+        """
+            Length is the length of the output, in samples.
+        """
+        self.length = length
+        self.sources = [None]       #   Sample filenames, by source number
+        self.events = numpy.zeros(16, dtype=event)
+        self.count = 0
+        self.groups = 0
+
+    def __len__(self):
+        return self.count
+
+    def source(self, name):
+        """
+            Source number of one of the remixer's samples (a filename from its template).
+        """
+        if not name in self.sources:
+            self.sources.append(name)
+        return self.sources.index(name)
+
+    def add(self, source, offset=0, length=-1, start=0, ratio=1.0, gain=1.0, limit=-1, group=-1):
+        """
+            Adds one event to the plan. Source is ORIGINAL, a source number, or a sample filename.
+        """
+        if isinstance(source, basestring):
+            source = self.source(source)
+        if self.count == len(self.events):
+            self.events = numpy.resize(self.events, 2 * len(self.events))
+        self.events[self.count] = (source, offset, length, ratio, gain, start, limit, group)
+        self.count += 1
+
+    def sample(self, name, start=0, gain=1.0, limit=-1):
+        """
+            Mixes in the whole of one of the remixer's samples.
+        """
+        self.add(name, start=start, gain=gain, limit=limit)
+
+    def hits(self, name, starts, gain=1.0, limit=-1):
+        """
+            Mixes in the whole of one of the remixer's samples at every position in starts
+            (an array of output positions, in samples) - i.e.: a drum hit - all at once.
+        """
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        needed = self.count + len(starts)
+        if needed > len(self.events):
+            self.events = numpy.resize(self.events, max(needed, 2 * len(self.events)))
+        added = self.events[self.count:needed]
+        added['source'] = self.source(name) if isinstance(name, basestring) else name
+        added['offset'] = 0
+        added['length'] = -1
+        added['ratio'] = 1.0
+        added['gain'] = gain
+        added['start'] = starts
+        added['limit'] = limit
+        added['group'] = -1
+        self.count = needed
+
+    def group(self, spans, start=0, ratio=1.0, gain=1.0, limit=-1, source=ORIGINAL):
+        """
+            Mixes in a list of (start, end) spans of a source (i.e.: from audiobuffer.bounds()),
+            played back to back, and stretched together by ratio.
+        """
+        group = self.groups
+        self.groups += 1
+        for begin, end in spans:
+            self.add(source, begin, end - begin, start, ratio, gain, limit, group)
+        return group
+
+    def pieces(self):
+        """
+            Turns the plan's events into the pieces that are actually rendered, in order of output position:
+            a list of (source, [(offset, length), ...], ratio, gain, start, limit).
+            Events that share a group become one piece. Ungrouped events that carry on exactly where
+            the previous event left off (same source, ratio and gain, contiguous in the source and the output)
+            are coalesced into one piece too, so they're read - and stretched - in one go.
+        """
+        pieces = []
+        lastgroup = None
+        for e in self.events[:self.count]:
+            source, offset, length, ratio, gain, start, limit, group = [x.item() for x in e]
+            if group >= 0 and group == lastgroup:
+                pieces[-1][1].append((offset, length))
+                continue
+            if group < 0 and pieces and lastgroup is None:
+                p = pieces[-1]
+                o, l = p[1][-1]
+                if p[0] == source and p[2] == ratio == 1.0 and p[3] == gain and p[5] < 0 and limit < 0 \
+                   and l >= 0 and length >= 0 and o + l == offset and p[4] + sum([n for _, n in p[1]]) == start:
+                    p[1].append((offset, length))
+                    continue
+            pieces.append((source, [(offset, length)], ratio, gain, start, limit))
+            lastgroup = group if group >= 0 else None
+        pieces.sort(key=lambda p: p[4])
+        return pieces
+
+    def dump(self):
+        """
+            The plan as text, one event per line - for logging, or diffing plans between versions.
+        """
+        lines = ["# length %s, sources: %s" % (self.length, ', '.join(["%s=%s" % (i, s or 'original') for i, s in enumerate(self.sources)]))]
+        lines.append('\t'.join(event.names))
+        for e in self.events[:self.count]:
+            lines.append('\t'.join([("%.6g" % x) if isinstance(x, float) else str(x) for x in [v.item() for v in e]]))
+        return '\n'.join(lines)
+
+class Renderer():
+    def __init__(self, original, samples, stretcher, cache=None, numChannels=2):
+        """
+            Original is the AudioData of the song being remixed, samples is the remixer's SampleBank,
+            and stretcher is anything with a FastModify-style shiftTempo(audiodata, ratio).
+            Cache, if given, is a dict-like object that stretched pieces are kept in,
+            keyed by source, spans and ratio - so the same beats are never stretched twice.
+            Unstretched pieces aren't cached: they're cheap to read again, and often just views.
+        """
+        self.original = original
+        self.samples = samples
+        self.stretcher = stretcher
+        self.cache = cache
+        self.numChannels = numChannels
+
+    def source(self, plan, number):
+        if number == ORIGINAL:
+            return self.original
+        return self.samples.get(plan.sources[number])
+
+    def piece(self, plan, piece):
+        """
+            Reads (and stretches) one piece of a plan. Returns its samples as an int16 array.
+        """
+        source, spans, ratio, gain, start, limit = piece
+        key = (plan.sources[source], tuple(spans), ratio)
+        cache = self.cache if ratio != 1.0 else None
+        if cache is not None and key in cache:
+            return cache[key]
+
+        audiodata = self.source(plan, source)
+        data = audiobuffer.frames(audiodata)
+        spans = [(offset, len(data) - offset if length < 0 else length) for offset, length in spans]
+        if len(spans) == 1:
+            offset, length = spans[0]
+            data = data[offset:offset + length]
+        else:
+            out = numpy.empty((sum([length for offset, length in spans]),) + data.shape[1:], dtype=data.dtype)
+            position = 0
+            for offset, length in spans:
+                chunk = data[offset:offset + length]
+                out[position:position + len(chunk)] = chunk
+                position += len(chunk)
+            data = out[:position]
+        if self.numChannels == 2:
+            data = audiobuffer.frames(audiobuffer.stereo(audiobuffer.view(data, audiodata.sampleRate)))
+        if ratio != 1.0:
+            data = audiobuffer.frames(self.stretcher.shiftTempo(audiobuffer.view(data, audiodata.sampleRate), ratio))
+        if cache is not None:
+            cache[key] = data
+        return data
+
+    def end(self, start, data, limit):
+        return start + (len(data) if limit < 0 else min(limit, len(data)))
+
+    def mixInto(self, acc, begin, start, data, gain, limit):
+        """
+            Adds the part of a piece that falls within [begin, begin + len(acc)) to the accumulator.
+            Returns where the piece ends in the output.
+        """
+        end = self.end(start, data, limit)
+        lo, hi = max(start, begin), min(end, begin + len(acc))
+        if hi > lo and gain:
+            numpy.add(acc[lo - begin:hi - begin], data[lo - start:hi - start].reshape((hi - lo, -1)) * gain, out=acc[lo - begin:hi - begin], casting='unsafe')
+        return end
+
+    def stream(self, plan, chunk=None):
+        """
+            Renders a plan in chunks of at most `chunk` samples, yielding an AudioData for each.
+            Pieces are only read when the output reaches them, and let go once it's past them.
+        """
+        length = plan.length
+        pieces = plan.pieces()
+        if not length:
+            #   No length given: render everything, then we'll know.
+            length = max([self.end(p[4], self.piece(plan, p), p[5]) for p in pieces] or [0])
+        if not length:
+            return      #   Nothing to render: render() falls back to silence
+        chunk = chunk or length
+        sampleRate = self.original.sampleRate if self.original else 44100
+        active = []
+        upcoming = 0    #   index of the first piece that hasn't been reached yet
+        for begin in xrange(0, length, chunk):
+            size = min(chunk, length - begin)
+            acc = audiobuffer.accumulator('render', size, self.numChannels)
+            acc.fill(0)
+            while upcoming < len(pieces) and pieces[upcoming][4] < begin + size:
+                p = pieces[upcoming]
+                upcoming += 1
+                active.append((p, self.piece(plan, p)))
+            still = []
+            for p, data in active:
+                if self.mixInto(acc, begin, p[4], data, p[3], p[5]) > begin + size:
+                    still.append((p, data))
+            active = still
+            numpy.clip(acc, -32768, 32767, out=acc)
+            out = numpy.empty((size, self.numChannels), dtype=numpy.int16)
+            out[:] = acc
+            yield audiobuffer.view(out, sampleRate)
+
+    def render(self, plan):
+        """
+            Renders a whole plan into one new AudioData.
+        """
+        for whole in self.stream(plan):
+            return whole
+        return audiobuffer.silence(0, self.numChannels)
@@ -0,0 +1,147 @@
+"""
+resultcache.py
+
+Content-addressed store of finished remixes.
+Entries are keyed by (hash of the uploaded file, remixer class, template version), and hold
+hardlinks to the remixed MP3 and its artwork, plus the remix's final progress message.
+When somebody uploads a song that's already been remixed in the same style, the
+CachedRemixer hands them the stored result instead of remixing it all over again.
+
+by Peter Sobot <hi@petersobot.com>
+"""
+from helpers.diskcache import DiskCache
+from remixer import Remixer
+from hashlib import md5
+import os, shutil, cPickle, time, config
+
+def templateVersion(remixer):
+    """
+        Short fingerprint of a remixer's template, so changing samples or tempo invalidates old results.
+    """
+    return md5(repr(sorted(getattr(remixer, 'template', {}).items()))).hexdigest()[:8]
+
+def link(source, destination):
+    """
+        Hardlinks a file if possible, or copies it if not. (i.e.: across filesystems)
+    """
+    if os.path.exists(destination):
+        os.unlink(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+class ResultCache(DiskCache):
+    files = ['remixed', 'art', 'thumbnail']   #   Tag entries that point to files worth keeping
+
+    def __init__(self, directory=None, max_bytes=None):
+        DiskCache.__init__(
+            self,
+            directory or config.result_cache_directory,
+            max_bytes if max_bytes is not None else config.result_cache_size
+        )
+
+    def key(self, hash, remixer):
+        return "%s-%s-%s" % (hash, remixer.__name__, templateVersion(remixer))
+
+    def get(self, hash, remixer):
+        """
+            Returns the stored entry for this song and remixer, or None
+            if it's not there (or some of its files have been evicted).
+        """
+        filename = self.path(self.key(hash, remixer), '.result')
+        try:
+            f = open(filename, 'rb')
+            entry = cPickle.load(f)
+            f.close()
+        except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+            return None
+        stored = entry['files'].values()
+        if not all([os.path.isfile(p) for p in stored]):
+            return None
+        for p in stored + [filename]:
+            self.touch(p)
+        return entry
+
+    def put(self, hash, remixer, final):
+        """
+            Stores the output of a successful remix, given its final progress message.
+        """
+        key = self.key(hash, remixer)
+        tag = final.get('tag', {})
+        entry = { 'final': final, 'files': {} }
+        self.mkdir()
+        for k in self.files:
+            if tag.get(k) and os.path.isfile(tag[k]):
+                stored = self.path(key, ".%s%s" % (k, os.path.splitext(tag[k])[1]))
+                link(tag[k], stored)
+                entry['files'][k] = stored
+        if not 'remixed' in entry['files']:
+            return
+
+        filename = self.path(key, '.result')
+        temp = self.tempfile(filename)
+        f = open(temp, 'wb')
+        cPickle.dump(entry, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        self.commit(temp, filename)
+
+    def restore(self, entry, uid, outfile):
+        """
+            Links a stored result into place for a new upload,
+            and returns that upload's final progress message.
+        """
+        final = dict(entry['final'])
+        tag = dict(final.get('tag', {}))
+        for k, stored in entry['files'].iteritems():
+            if k == 'remixed':
+                destination = outfile
+            else:
+                suffix = '.thumb' if k == 'thumbnail' else ''
+                destination = os.path.join(os.path.dirname(outfile), "%s%s%s" % (uid, suffix, os.path.splitext(stored)[1]))
+            link(stored, destination)
+            tag[k] = destination
+        final['tag'] = tag
+        final['uid'] = uid
+        final['time'] = time.time()
+        final['cached'] = True
+        return final
+
+class CachedRemixer(Remixer):
+    """
+        Stands in for a real remixer when an identical remix already exists.
+        Goes through the usual start(), progress callback and parent.finish() motions
+        (on the IOLoop, just like a real remix), but just links the stored result
+        into place instead of spawning a remix process.
+    """
+    def __init__(self, parent, infile, outfile, callbacks, entry, cache):
+        Remixer.__init__(self, parent, infile, outfile, callbacks)
+        self.entry = entry
+        self.cache = cache
+
+    def start(self):
+        self.started = time.time()
+        self.status = 1
+        self.last = None
+        self.alive = True
+        self.ioloop.add_callback(self.run)
+
+    def stop(self):
+        self.status = -1
+
+    def run(self):
+        if self.status != -1:
+            try:
+                final = self.cache.restore(self.entry, self.uid, self.outfile)
+                if hasattr(self.parent, 'updateTrack'):
+                    self.parent.updateTrack(self.uid, final['tag'])
+                self.last = final
+                for callback in self.callbacks:
+                    callback(final)
+            except Exception, e:
+                self.status = -1
+                self.handleError(e)
+        self.alive = False
+        self.cleanup()
+        if hasattr(self.parent, 'finish'):
+            self.parent.finish(self.uid, self.last)
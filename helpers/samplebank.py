@@ -0,0 +1,86 @@
+"""
+samplebank.py
+
+Pre-decoded, memory-mapped copies of the audio samples that remixers use.
+
+The first time a sample is needed, it's decoded once and saved as a raw int16 .npy file
+in the sample cache directory. From then on, it's opened read-only with numpy's mmap_mode,
+so every remix process on the box shares the same pages of the same file - no more decoding
+samples from disk for every section, and no extra memory per concurrent remix.
+
+by Peter Sobot <hi@petersobot.com>
+"""
+from os import path, makedirs, rename, getpid
+from helpers.audiobuffer import view
+import echonest.audio as audio
+import numpy, config
+
+banks = {}  #   One bank per sample directory, per process.
+
+def bank(sample_path, template):
+    """
+        Returns this process's SampleBank for the given sample directory.
+    """
+    if not sample_path in banks:
+        banks[sample_path] = SampleBank(sample_path, template)
+    return banks[sample_path]
+
+def templateFiles(template):
+    """
+        Lists every sample filename mentioned in a remixer's template dict.
+    """
+    files = []
+    for v in template.itervalues():
+        for f in (v if isinstance(v, list) else [v]):
+            if isinstance(f, basestring) and f.endswith('.wav'):
+                files.append(f)
+    return files
+
+class SampleBank():
+    def __init__(self, sample_path, template):
+        self.sample_path = sample_path
+        self.files = templateFiles(template)
+        self.directory = path.join(config.sample_cache_directory, path.basename(path.normpath(sample_path)))
+        self.samples = {}
+
+    def cachefile(self, name):
+        return path.join(self.directory, "%s.npy" % name)
+
+    def convert(self, name):
+        """
+            Decodes a sample to stereo 44.1kHz int16 and saves it to the cache.
+            Written to a temporary file first, so concurrent processes never see half a sample.
+        """
+        cache = self.cachefile(name)
+        if not path.isdir(path.dirname(cache)):
+            try:
+                makedirs(path.dirname(cache))
+            except OSError:
+                pass    #   Another process got there first
+        decoded = audio.AudioData(self.sample_path + name, sampleRate=44100, numChannels=2, verbose=False)
+        temp = "%s.%s.tmp" % (cache, getpid())
+        f = open(temp, 'wb')
+        numpy.save(f, decoded.data[:decoded.endindex])
+        f.close()
+        rename(temp, cache)
+        decoded.unload()
+
+    def get(self, name):
+        """
+            Returns an AudioData whose data is a read-only memory map of the named sample.
+        """
+        if not name in self.samples:
+            source = self.sample_path + name
+            cache = self.cachefile(name)
+            if not path.isfile(cache) or path.getmtime(cache) < path.getmtime(source):
+                self.convert(name)
+            self.samples[name] = numpy.load(cache, mmap_mode='r')
+        return view(self.samples[name])
+
+    def preload(self):
+        """
+            Decodes and maps every sample in the template that exists on disk.
+        """
+        for name in self.files:
+            if path.isfile(self.sample_path + name):
+                self.get(name)
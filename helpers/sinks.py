@@ -0,0 +1,98 @@
+"""
+sinks.py
+
+Incremental audio outputs for remixers.
+Each sink is opened once per remix and has AudioData appended to it as it is produced,
+so a remix never has to hold (or write out) more than one section at a time.
+
+by Peter Sobot <hi@petersobot.com>
+"""
+import wave, numpy, subprocess, os
+
+class WavSink():
+    """
+        Appends AudioData objects to a single open WAV file.
+        The header is written with a zero length at first, and patched on close().
+    """
+    def __init__(self, filename, sampleRate=44100, numChannels=2):
+        self.filename = filename
+        self.sampleRate = sampleRate
+        self.numChannels = numChannels
+        self.wav = wave.open(filename, 'wb')
+        self.wav.setnchannels(numChannels)
+        self.wav.setsampwidth(2)
+        self.wav.setframerate(sampleRate)
+
+    def samples(self, audiodata):
+        """
+            Returns the little-endian int16 samples of an AudioData, shaped to fit this sink.
+        """
+        data = audiodata.data[:audiodata.endindex] if audiodata.endindex else audiodata.data
+        if audiodata.sampleRate != self.sampleRate:
+            raise ValueError("Can't append %sHz audio to a %sHz sink." % (audiodata.sampleRate, self.sampleRate))
+        if data.ndim == 1 and self.numChannels == 2:
+            stereo = numpy.empty((len(data), 2), dtype='<i2')
+            stereo[:] = data[:, numpy.newaxis]
+            return stereo
+        channels = 1 if data.ndim == 1 else data.shape[1]
+        if channels != self.numChannels:
+            raise ValueError("Can't append %s-channel audio to a %s-channel sink." % (channels, self.numChannels))
+        return numpy.ascontiguousarray(data, dtype='<i2')
+
+    def write(self, audiodata):
+        data = self.samples(audiodata)
+        self.wav.writeframesraw(data.data)
+
+    def close(self):
+        if self.wav:
+            self.wav.close()
+            self.wav = None
+
+    def abort(self):
+        self.close()
+
+class LameSink(WavSink):
+    """
+        Pipes raw PCM straight into a running LAME process, which encodes
+        it to an MP3 while the rest of the remix is still being arranged.
+        No intermediate WAV file is ever written.
+    """
+    def __init__(self, filename, sampleRate=44100, numChannels=2):
+        self.filename = filename
+        self.sampleRate = sampleRate
+        self.numChannels = numChannels
+        self.process = subprocess.Popen(
+            ['lame', '-S',
+             '-r', '-s', '%g' % (sampleRate / 1000.0), '--bitwidth', '16', '--signed', '--little-endian',
+             '-m', 'j' if numChannels == 2 else 'm',
+             '--preset', 'fast', 'medium', '-', str(filename)],
+            stdin=subprocess.PIPE
+        )
+
+    def write(self, audiodata):
+        data = self.samples(audiodata)
+        self.process.stdin.write(data.data)
+
+    def close(self):
+        """
+            Signals the end of the audio to LAME and waits for it to finish writing the MP3.
+        """
+        if self.process:
+            self.process.stdin.close()
+            r = self.process.wait()
+            self.process = None
+            if r:
+                raise subprocess.CalledProcessError(r, 'lame')
+
+    def abort(self):
+        """
+            Kills LAME and throws away whatever it's written so far.
+        """
+        if self.process:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+            try:
+                os.unlink(self.filename)
+            except OSError:
+                pass
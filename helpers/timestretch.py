@@ -0,0 +1,161 @@
+"""
+timestretch.py
+
+In-process tempo shifting for FastModify, without the soundstretch round trip.
+Implements WSOLA (Waveform Similarity Overlap-Add) directly on the int16
+arrays held by echonest's AudioData, so no temp files or subprocesses are needed.
+
+by Peter Sobot <hi@petersobot.com>
+"""
+import numpy
+
+FRAME =     2048    #   samples per analysis/synthesis frame (~46ms at 44.1kHz)
+OVERLAP =   FRAME / 2
+TOLERANCE = 512     #   max samples a frame may slide to find a good splice
+
+WINDOW = (0.5 - 0.5 * numpy.cos(2 * numpy.pi * numpy.arange(FRAME) / FRAME)).astype(numpy.float32)
+FFTSIZE = 1 << int(numpy.ceil(numpy.log2(FRAME + 2 * TOLERANCE)))
+
+
+def splice(template, region):
+    """
+        Returns the offset into region (0 - 2*TOLERANCE) that best matches
+        the template waveform, by FFT cross-correlation.
+    """
+    corr = numpy.fft.irfft(
+        numpy.fft.rfft(region, FFTSIZE) * numpy.conj(numpy.fft.rfft(template, FFTSIZE)),
+        FFTSIZE
+    )
+    return int(numpy.argmax(corr[:len(region) - len(template) + 1]))
+
+
+def resample(data, length):
+    """
+        Linearly resamples data to the given length.
+        Only used for clips shorter than a single frame, where WSOLA can't work.
+    """
+    if not len(data) or not length:
+        return numpy.zeros((length,) + data.shape[1:], dtype=numpy.int16)
+    positions = numpy.linspace(0, len(data) - 1, length)
+    if data.ndim == 1:
+        return numpy.interp(positions, numpy.arange(len(data)), data).astype(numpy.int16)
+    out = numpy.empty((length, data.shape[1]), dtype=numpy.int16)
+    for c in xrange(data.shape[1]):
+        out[:, c] = numpy.interp(positions, numpy.arange(len(data)), data[:, c])
+    return out
+
+
+class Stretcher():
+    """
+        Streaming WSOLA. Feed it consecutive chunks of a recording, of any size, and it returns
+        as much stretched audio as it can for each one; flush() returns the rest at the end.
+        Only a few frames of input and output are kept between chunks, so memory use
+        doesn't grow with the length of the recording - and the result is exactly
+        what stretch() would return for the whole thing at once.
+    """
+    def __init__(self, ratio, channels=None):
+        """
+            Channels is the number of columns in each chunk, or None for one-dimensional chunks.
+        """
+        self.ratio = float(ratio)
+        self.hop = OVERLAP * self.ratio
+        self.shape = () if channels is None else (channels,)
+        self.window = WINDOW if channels is None else WINDOW[:, numpy.newaxis]
+        self.input = numpy.zeros((TOLERANCE,) + self.shape, dtype=numpy.float32)   #   Starts with TOLERANCE samples of padding
+        self.base = 0           #   Position of self.input[0] in the padded input
+        self.received = 0       #   Samples fed in so far
+        self.k = 0              #   Next frame to synthesise
+        self.previous = TOLERANCE
+        self.tail = numpy.zeros((OVERLAP,) + self.shape, dtype=numpy.float32)
+        self.tailweight = numpy.zeros(OVERLAP, dtype=numpy.float32)
+        self.ready = []         #   Finished output that can't be returned yet
+        self.emitted = 0
+
+    def mono(self, begin, end):
+        region = self.input[begin - self.base:end - self.base]
+        return region if region.ndim == 1 else region.mean(axis=1)
+
+    def needed(self):
+        """
+            How much of the padded input the next frame reads.
+            (The first frame waits for enough input to tell whether WSOLA can be used at all.)
+        """
+        if not self.k:
+            return TOLERANCE + FRAME + 2 * TOLERANCE
+        return max(self.previous + OVERLAP + FRAME, int(self.k * self.hop) + FRAME + 2 * TOLERANCE)
+
+    def frame(self):
+        """
+            Synthesises the next frame, finishing off OVERLAP more samples of output.
+        """
+        if self.k:
+            #   Choose the frame near its nominal position that best continues the last one
+            nominal = int(self.k * self.hop)
+            template = self.mono(self.previous + OVERLAP, self.previous + OVERLAP + FRAME)
+            position = nominal + splice(template, self.mono(nominal, nominal + FRAME + 2 * TOLERANCE))
+        else:
+            position = TOLERANCE
+        segment = self.input[position - self.base:position - self.base + FRAME] * self.window
+        weight = numpy.maximum(self.tailweight + WINDOW[:OVERLAP], 1e-3)
+        self.ready.append((self.tail + segment[:OVERLAP]) / (weight if not self.shape else weight[:, numpy.newaxis]))
+        self.tail = segment[OVERLAP:]
+        self.tailweight = WINDOW[OVERLAP:]
+        self.previous = position
+        self.k += 1
+
+    def output(self, limit):
+        """
+            Returns finished output as int16, up to `limit` samples in total.
+        """
+        ready = numpy.concatenate(self.ready) if self.ready else numpy.zeros((0,) + self.shape, dtype=numpy.float32)
+        count = max(0, min(len(ready), limit - self.emitted))
+        self.ready = [ready[count:]] if count < len(ready) else []
+        self.emitted += count
+        return numpy.clip(ready[:count], -32768, 32767).astype(numpy.int16)
+
+    def feed(self, data):
+        if self.ratio == 1:
+            #   Nothing to stretch: pass the audio straight through
+            self.received += len(data)
+            self.emitted += len(data)
+            return numpy.asarray(data, dtype=numpy.int16)
+        self.input = numpy.concatenate((self.input, numpy.asarray(data, dtype=numpy.float32)))
+        self.received += len(data)
+        while self.base + len(self.input) >= self.needed():
+            self.frame()
+        if self.k:
+            #   Let go of input that no later frame can reach
+            keep = min(self.previous + OVERLAP, int(self.k * self.hop))
+            if keep > self.base:
+                self.input = self.input[keep - self.base:]
+                self.base = keep
+        #   Never return more than the final output could be, before we know how long it is
+        return self.output(int(round(self.received / self.ratio)))
+
+    def flush(self):
+        if self.ratio == 1:
+            return numpy.zeros((0,) + self.shape, dtype=numpy.int16)
+        length = int(round(self.received / self.ratio))
+        if self.received < FRAME + 2 * TOLERANCE:
+            return resample(self.input[TOLERANCE:], length)
+        frames = int(numpy.ceil(float(length) / OVERLAP)) + 1
+        end = int(frames * self.hop) + FRAME + 2 * TOLERANCE + OVERLAP
+        if end > self.base + len(self.input):
+            padding = numpy.zeros((end - self.base - len(self.input),) + self.shape, dtype=numpy.float32)
+            self.input = numpy.concatenate((self.input, padding))
+        while self.k < frames:
+            self.frame()
+        return self.output(length)
+
+
+def stretch(data, ratio):
+    """
+        Time-stretches an int16 sample array (shape (n,) or (n, channels))
+        by the given tempo ratio without changing its pitch.
+        A ratio of 2 plays twice as fast (half as long), matching soundstretch's -tempo.
+        Returns a new int16 array - or data itself, untouched, if the ratio is 1.
+    """
+    if ratio == 1:
+        return data
+    stretcher = Stretcher(ratio, data.shape[1] if data.ndim > 1 else None)
+    return numpy.concatenate((stretcher.feed(data), stretcher.flush()))
@@ -0,0 +1,195 @@
+"""
+workerpool.py
+
+A pool of long-lived remix processes, forked once when the server starts.
+
+Every Remixer used to fork a brand new process for its remix, which then had to
+map all of its samples and warm up its allocator before doing any work - and threw
+all of that away when it exited. Workers in this pool do that once, then take
+remix jobs over a pipe, one at a time, and send progress back down the same pipe.
+Workers are recycled after config.worker_max_jobs remixes, or once their peak
+memory usage passes config.worker_max_rss, so leaks can't pile up.
+
+by Peter Sobot <hi@petersobot.com>
+"""
+from multiprocessing import Process, Pipe
+from helpers import samplebank
+import tornado.ioloop
+import os, time, resource, logging, traceback, config
+
+def serve(conn, parent, remixers, siblings):
+    """
+        Main loop of a worker process.
+        Receives (remixer class, infile, outfile, attributes) jobs until it's told to stop with None,
+        and after each one replies 'ready' - or 'retire', and exits.
+    """
+    for sibling in siblings:
+        sibling.close()     #   So other workers see EOF if the server goes away
+    for remixer in remixers:
+        try:
+            samplebank.bank('samples/%s/' % remixer.__name__.lower(), getattr(remixer, 'template', {})).preload()
+        except:
+            logging.getLogger().warning("Worker %s could not preload samples for %s:\n%s" % (os.getpid(), remixer.__name__, traceback.format_exc()))
+
+    jobs = 0
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, IOError):
+            break
+        if job is None:
+            break
+        cls, infile, outfile, attributes = job
+        remixer = cls(parent, infile, outfile)
+        for k, v in attributes.iteritems():
+            setattr(remixer, k, v)
+        remixer.conn = conn
+        remixer._remix()
+        del remixer
+
+        jobs += 1
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # ru_maxrss is in kilobytes
+        if jobs >= config.worker_max_jobs or rss > config.worker_max_rss:
+            conn.send('retire')
+            break
+        conn.send('ready')
+    conn.close()
+
+class Worker():
+    """
+        The server's end of one worker process.
+        While it's running a job, the remixer reads its progress straight off self.conn.
+    """
+    attributes = ['hash', 'deleteOriginal']     #   Remixer attributes that are sent along with each job
+
+    def __init__(self, parent, remixers, siblings):
+        self.conn, child = Pipe()
+        self.process = Process(target=serve, args=(child, parent, remixers, siblings))
+        self.process.daemon = False     #   Workers fork section pools of their own, which daemons can't do.
+        self.process.start()
+        child.close()
+        self.jobs = 0
+
+    def submit(self, remixer):
+        self.conn.send((
+            remixer.__class__,
+            remixer.infile,
+            remixer.outfile,
+            dict([(k, getattr(remixer, k)) for k in self.attributes])
+        ))
+        self.jobs += 1
+        return self
+
+    def finished(self):
+        """
+            Whether the worker has said it's ready for another job after its remix.
+        """
+        try:
+            if self.conn.poll():
+                return self.conn.recv() == 'ready'
+        except (EOFError, IOError):
+            pass
+        return False
+
+    def kill(self):
+        try:
+            self.conn.close()
+        except:
+            pass
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join(1)
+
+class WorkerPool():
+    """
+        Everything here runs on the IOLoop's thread, so there's no locking.
+    """
+    handback_timeout = 30   #   seconds a worker gets to clean up after a remix, before it's replaced
+
+    def __init__(self, parent, remixers, size=None):
+        self.log = logging.getLogger()
+        self.parent = parent
+        self.ioloop = getattr(parent, 'ioloop', None) or tornado.ioloop.IOLoop.instance()
+        self.remixers = remixers
+        self.size = size if size is not None else config.worker_pool_size
+        self.idle = []
+        self.busy = []      #   Running a remix, or cleaning up after one
+        for i in xrange(self.size):
+            self.idle.append(self.spawn())
+
+    def spawn(self):
+        worker = Worker(self.parent, self.remixers, [w.conn for w in self.idle + self.busy])
+        self.log.info("Started remix worker %s." % worker.process.pid)
+        return worker
+
+    def acquire(self):
+        """
+            Returns an idle worker - or a fresh one, if a dead one had to be replaced.
+            Returns None if all of the pool's workers are busy: the pool never grows past its size,
+            so the remix should get a process of its own instead.
+        """
+        while self.idle and not self.idle[0].process.is_alive():
+            self.idle.pop(0).kill()
+        if self.idle:
+            worker = self.idle.pop(0)
+        elif len(self.busy) < self.size:
+            worker = self.spawn()
+        else:
+            return None
+        self.busy.append(worker)
+        return worker
+
+    def release(self, worker, completed=True, callback=None):
+        """
+            Hands a worker back after a remix. Workers that didn't finish their job cleanly
+            (i.e.: remixes that were stopped or timed out) are killed rather than reused.
+            Otherwise, the worker goes back to the idle list once it says it's ready
+            (it still has to clean up after its remix), without blocking the IOLoop.
+            Callback, if given, is called once the worker is back in the pool (or replaced).
+        """
+        if not completed:
+            self.recycle(worker)
+            if callback:
+                callback()
+            return
+        fd = worker.conn.fileno()
+        timer = []
+        def handback(fd=None, events=None):
+            self.ioloop.remove_handler(worker.conn.fileno())
+            if timer:
+                self.ioloop.remove_timeout(timer.pop())
+            if worker.finished() and len(self.idle) < self.size:
+                self.busy.remove(worker)
+                self.idle.append(worker)
+            else:
+                self.recycle(worker)
+            if callback:
+                callback()
+        self.ioloop.add_handler(fd, handback, self.ioloop.READ | self.ioloop.ERROR)
+        timer.append(self.ioloop.add_timeout(time.time() + self.handback_timeout, handback))
+
+    def recycle(self, worker):
+        if worker in self.busy:
+            self.busy.remove(worker)
+        self.log.info("Recycling remix worker %s after %s jobs." % (worker.process.pid, worker.jobs))
+        worker.kill()
+        if len(self.idle) + len(self.busy) < self.size:
+            self.idle.append(self.spawn())
+
+    def stop(self):
+        """
+            Shuts down every worker. Must be called before the server exits,
+            or multiprocessing will wait on these (non-daemonic) processes forever.
+        """
+        for worker in self.busy:
+            try:
+                self.ioloop.remove_handler(worker.conn.fileno())     #   i.e.: still waiting for a handback
+            except:
+                pass
+        workers, self.idle, self.busy = self.idle + self.busy, [], []
+        for worker in workers:
+            try:
+                worker.conn.send(None)
+            except:
+                pass
+            worker.kill()
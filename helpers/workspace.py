@@ -0,0 +1,156 @@
+"""
+workspace.py
+
+Scratch space for one remix: every temporary file a remix writes (its decoded source,
+intermediate WAV, artwork, soundstretch round trips...) goes in a directory of its own,
+which is removed in one go when the remix ends - so nothing is left behind to fill the disk.
+
+If config.scratch_tmpfs_directory is set (i.e.: to somewhere under /dev/shm), files are
+put there instead of on disk, as long as all remixes' files there stay within
+config.scratch_tmpfs_bytes. Each file's (estimated) size is reserved when it's placed, and each
+workspace writes what it has reserved to <uid>.reserved next to its directory - so files that
+fit one at a time can't overflow the tmpfs together, even from different remix processes.
+Placements are made under a lock on the tmpfs directory, and every one counts what all the
+other workspaces there hold afresh. Files that won't fit - or whose size isn't known, and so
+might grow without bound - go to the disk side of the workspace instead.
+
+by Peter Sobot <hi@petersobot.com>
+"""
+import os, shutil, fcntl, config
+
+def usage(directory):
+    """
+        Total size, in bytes, of every file under directory.
+    """
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass    #   Removed by another remix while we were looking
+    return total
+
+def reservation(filename):
+    """
+        Bytes a workspace has reserved, from its .reserved file - or 0 if it has none.
+    """
+    try:
+        return int(open(filename).read() or 0)
+    except (IOError, OSError, ValueError):
+        return 0
+
+def free(directory):
+    try:
+        s = os.statvfs(directory)
+        return s.f_bavail * s.f_frsize
+    except (OSError, AttributeError):
+        return 0
+
+class Workspace():
+    """
+        Directories are named after the remix's uid and only created once a file is placed in them,
+        so the server can make a Workspace for a remix that ran in another process, just to remove() it.
+    """
+    def __init__(self, uid):
+        self.uid = uid
+        if os.access('tmp/', os.W_OK):
+            self.disk = os.path.join('tmp', uid)
+        else:
+            self.disk = os.path.join('.', "%s.tmp" % uid)
+        self.fastroot = config.scratch_tmpfs_directory or None
+        self.fast = os.path.join(self.fastroot, uid) if self.fastroot else None
+        self.marker = os.path.join(self.fastroot, "%s.reserved" % uid) if self.fastroot else None
+        self.placed = {}        #   Path of each file put on the tmpfs -> [bytes reserved for it, whether it's been written yet]
+
+    def reserved(self):
+        """
+            Bytes reserved by this workspace's files on the tmpfs. Files that have been written and
+            then deleted give theirs back; ones that haven't been written yet keep it.
+        """
+        for p, entry in self.placed.items():
+            if os.path.exists(p):
+                entry[1] = True
+            elif entry[1]:
+                del self.placed[p]
+        return sum([size for size, written in self.placed.itervalues()])
+
+    def release(self, p):
+        """
+            Gives back the space reserved for a file, i.e.: once it's been deleted.
+        """
+        if self.placed.pop(p, None):
+            self.mark()
+
+    def mark(self):
+        """
+            Writes how much this workspace has reserved on the tmpfs, for other remixes to count.
+        """
+        try:
+            f = open(self.marker, 'w')
+            f.write(str(self.reserved()))
+            f.close()
+        except (IOError, OSError):
+            pass
+
+    def others(self):
+        """
+            Bytes held on the tmpfs by every other workspace: what's in its directory,
+            or what it has reserved, whichever is more.
+        """
+        held = {}
+        for name in os.listdir(self.fastroot):
+            full = os.path.join(self.fastroot, name)
+            if name.endswith('.reserved'):
+                uid = name[:-len('.reserved')]
+                held[uid] = max(held.get(uid, 0), reservation(full))
+            elif os.path.isdir(full):
+                held[name] = max(held.get(name, 0), usage(full))
+        held.pop(self.uid, None)
+        return sum(held.itervalues())
+
+    def reserve(self, p, size):
+        """
+            Reserves size bytes on the tmpfs for the file at p, if they fit within its budget.
+            Returns whether they did.
+        """
+        if not self.fastroot or not size or size <= 0:
+            return False
+        try:
+            if not os.path.isdir(self.fastroot):
+                os.makedirs(self.fastroot)
+            lock = open(os.path.join(self.fastroot, '.lock'), 'a')
+        except (IOError, OSError):
+            return False
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            mine = max(self.reserved(), usage(self.fast) if os.path.isdir(self.fast) else 0)
+            if self.others() + mine + size > config.scratch_tmpfs_bytes or size >= free(self.fastroot):
+                return False
+            self.placed[p] = [size, False]
+            self.mark()
+            return True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def path(self, name, size=None):
+        """
+            Where to write a temporary file called name, of (an estimated) size bytes:
+            on the tmpfs if it fits, on disk otherwise - or if the size isn't known.
+        """
+        fast = self.fast and self.reserve(os.path.join(self.fast, name), size)
+        directory = self.fast if fast else self.disk
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return os.path.join(directory, name)
+
+    def remove(self):
+        for directory in [self.fast, self.disk]:
+            if directory:
+                shutil.rmtree(directory, True)
+        if self.marker and os.path.exists(self.marker):
+            try:
+                os.unlink(self.marker)
+            except OSError:
+                pass    #   Removed by the other process this remix ran in
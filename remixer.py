@@ -9,31 +9,50 @@ by Peter Sobot <hi@petersobot.com>
     v1: started Jan. 2011
     v2: August-Sept 2011
 """
-from numpy import array
-from os import rename, unlink, path, access, W_OK
-from threading import Thread
-from multiprocessing import Queue, Process
+from os import rename, unlink, path, getpid
+from multiprocessing import Process, Pipe, Pool, cpu_count
 from traceback import print_exception, format_exc
-from subprocess import check_call, call
+from subprocess import check_call
 from mutagen import File, id3
 from PIL import Image
+import numpy
 from echonest.selection import *
 from echonest.sorting import *
 import echonest.audio as audio
+import tornado.ioloop
+from helpers.sinks import WavSink, LameSink
+from helpers import samplebank, audiobuffer
+from helpers.diskcache import AnalysisCache, filehash
+from helpers.analysisindex import SegmentIndex
+from helpers.renderplan import Renderer
+from helpers.fastmodify import FastModify
+from helpers.procstats import Sampler
+from helpers.workspace import Workspace
 import time, sys, wave, mimetypes, config, logging, traceback
 
-class Remixer(Thread):
+#   The remixer, method and argument list that a section pool's workers render from.
+#   Set right before the pool forks, so each worker inherits it instead of having it pickled.
+_sections = None
+
+def _renderSection(i):
+    """
+        Runs in a section pool worker: renders section i, and sends back its raw sample arrays,
+        along with the worker's pid and its sectionStats() so far.
+    """
+    remixer, method, arglist = _sections
+    result = getattr(remixer, method)(*arglist[i])
+    parts = result if isinstance(result, tuple) else (result,)
+    return isinstance(result, tuple), [(numpy.asarray(audiobuffer.frames(a)), a.sampleRate) for a in parts], getpid(), remixer.sectionStats()
+
+class Remixer():
     """
         Generic song remixer to be inherited from and
         embedded in something bigger - i.e. a web app.
         (like the Wub Machine...)
 
-        Inherits from Thread to allow for asynchronous processing.
-
-        Workhorse function (run()) spawns a child process for the remixer,
-        then blocks for progress updates and calls callback functions when they occur.
-        Progress updates are kept in a queue and callbacks fired immediately if the
-        queue is not empty. Otherwise, the callback is fired when the progress update comes in.
+        Workhorse function (start()) spawns a child process for the remixer,
+        then watches the pipe from it on the Tornado IOLoop, and calls callback functions
+        (on the IOLoop's thread) whenever progress updates come in. No threads required.
 
         Child process is used for memory efficiency and to leverage multiple cores better.
         Spawn 4 remixers on a quad-core machine, and remix 4 tracks at once!
@@ -47,7 +66,7 @@ class Remixer(Thread):
             and a UID to identify the remix by.
             Logger should be a non-blocking function that needs to know *all* progress updates.
         """
-        #   Thread variables
+        #   Parent-side variables
         if isinstance(callbacks, list):
             self.callbacks =   callbacks
         else:
@@ -57,7 +76,20 @@ class Remixer(Thread):
         self.uid =       path.splitext(path.basename(infile))[0]
         self.extension = path.splitext(infile)[-1]
         self.timeout =   600     #   seconds
-        self.queue =     None    #   queue between thread and process
+        self.pool =      None    #   WorkerPool to remix in, instead of a new Process
+        self.ioloop =    getattr(parent, 'ioloop', None) or tornado.ioloop.IOLoop.instance()
+        self.reader =    None    #   parent's end of the pipe from the remix process
+        self.conn =      None    #   child's end of the same pipe
+        self.timer =     None    #   IOLoop timeout, reset on every progress update
+        self.sampler =   None    #   procstats.Sampler of the remix process, and the IOLoop timeout of its next sample
+        self.sampleTimer = None
+        self.resources = None    #   Sampler's totals, once the remix is done
+        self.alive =     False
+        self.handingBack = False #   True while a pool worker finishes up after the remix, before the parent hears it's done
+        self.completed = False   #   True once the child has closed the pipe properly
+        self.state =     {}      #   Parent's copy of the remix's progress, merged from each update
+        self.reported =  {}      #   Child's copy of the fields it's already sent up the pipe
+        self.reportedAt = 0
         self.errortext = "Sorry, that song didn't work. Try another!"
         self.started =   None
         self.status =    0
@@ -66,11 +98,10 @@ class Remixer(Thread):
         #   Remixer variables
         self.keys =      {0: "C", 1: "C#", 2: "D", 3: "Eb", 4: "E", 5:"F", 6:"F#", 7:"G", 8:"G#", 9:"A", 10:"Bb", 11:"B"}
         self.infile  =   str(infile)
-        if access('tmp/', W_OK):
-            self.tempdir =   'tmp/'
-        else:
-            self.tempdir =   './'
-        self.tempfile =  path.join(self.tempdir, "%s.wav" % self.uid)
+        self.hash =      None    #   MD5 of the input file, if already known (i.e.: Track.hash)
+        self.workspace = Workspace(self.uid)    #   Where every temp file goes (see helpers/workspace.py)
+        self.tempfile =  None    #   Intermediate WAV, placed in the workspace when it's opened
+        self.sourcefile = None   #   Decoded, memory-mapped input (if memmap_source), likewise
         self.outdir =    'static/songs/'
         self.overlay =   'static/img/overlay.png' # Transparent overlay to put on top of song artwork
         self.outfile =   outfile or path.join(path.dirname(self.infile), "%s.out.mp3" % self.uid)
@@ -80,9 +111,18 @@ class Remixer(Thread):
         self.progress =  0.0
         self.step =      None
         self.encoded =   0
+        self.sink =      None    #   open output that partialEncode() appends to
+        self.planlog =   None    #   file to write every RenderPlan to, if any (i.e.: for benchmarks)
+        self.stats =     {}      #   counters sent up with the final log entry (i.e.: cache hits and misses)
+        self.workerStats = {}    #   latest sectionStats() of each section pool worker, by pid
+        self.analysis_provider = None   #   function of infile that returns an analysis, instead of the Echo Nest (i.e.: for benchmarks)
+        self.timings =   {}      #   seconds spent in each stage of the remix, by stage name
+        self.stage =     None    #   stage the remix is in now, and when it started
+        self.stageStarted = None
         self.deleteOriginal = True
 
         self.sample_path = 'samples/%s/' % str(self.__class__.__name__).lower()
+        self.samples =   samplebank.bank(self.sample_path, getattr(self, 'template', {}))
         
         self.tag =       {}      #   Remix metadata tag
         self.original =  None    #   audio.LocalAudioFile-returned analysis
@@ -91,8 +131,8 @@ class Remixer(Thread):
         self.bars =      None
         self.beats =     None
         self.sections =  None
+        self.index =     None    #   SegmentIndex of self.original's segments
 
-        Thread.__init__(self)
 
 
     """
@@ -121,15 +161,63 @@ class Remixer(Thread):
 
     def log(self, text, progress):
         """
-            Pass progress updates back to the run() function, which then bubbles up to everybody watching this remix.
+            Pass progress updates back to the parent process, which then bubbles them up to everybody watching this remix.
             Automatically increments progress, which can be a fractional percentage or decimal percentage.
         """
         if progress > 1:
             progress *= 0.01
         self.progress += progress
         self.step = text
+        self.lap(text)
 
-        self.processqueue.put(self.logbase())
+        self.report(self.logbase())
+
+    def lap(self, text=None):
+        """
+            Ends the current stage of the remix, adding its time to self.timings, and starts the one named by text.
+            Stages are named after the first two words of the progress text, so song titles and
+            numbers are left out: "Arranging section 3 of 12..." counts towards "Arranging section".
+        """
+        now = time.time()
+        if self.stage:
+            self.timings[self.stage] = self.timings.get(self.stage, 0) + now - self.stageStarted
+        self.stage = ' '.join(text.split()[:2]).strip(' .') if text else None
+        self.stageStarted = now
+
+    def timed(self, update):
+        """
+            Adds the time spent in each stage so far to a progress update.
+        """
+        self.lap()
+        if self.timings:
+            update['timings'] = dict([(k, round(v, 4)) for k, v in self.timings.iteritems()])
+        return update
+
+    def report(self, update, force=False):
+        """
+            Sends a progress update up the pipe - but only the fields that have changed since the last one
+            (so the tag goes up once, and again only if it changes). Updates that only move the progress
+            along, with the same text, go out no more often than every config.progress_interval seconds;
+            the ones that come in quicker are coalesced into the next one, which a new step always sends.
+            New steps, status changes (and forced updates) go out right away.
+        """
+        if not force and update['status'] == self.reported.get('status') \
+           and update['text'] == self.reported.get('text') \
+           and time.time() - self.reportedAt < config.progress_interval:
+            return
+        delta = dict([(k, v) for k, v in update.iteritems() if self.reported.get(k, self) != v])
+        delta['uid'] = update['uid']
+        self.reported.update(delta)
+        if 'tag' in delta:
+            self.reported['tag'] = dict(delta['tag'])     #   self.tag keeps changing in place
+        self.reportedAt = time.time()
+        self.send(delta)
+
+    def send(self, message):
+        """
+            Sends a message up the pipe to the parent process. (Only called in the remix process.)
+        """
+        self.conn.send(message)
 
     def handleError(self, e):
         self.step = "Hmm... something went wrong. Please try again later!"
@@ -149,7 +237,7 @@ class Remixer(Thread):
         update['text'] = self.errortext
         update['debug'] = text
 
-        self.processqueue.put(update)
+        self.report(self.timed(update), True)
         self.close()
 
     def finish(self, text):
@@ -158,21 +246,26 @@ class Remixer(Thread):
         """
         self.progress = 1
         self.step = text
-        self.processqueue.put(self.logbase())
+        update = self.logbase()
+        if self.stats:
+            update['stats'] = self.stats
+        self.report(self.timed(update), True)
         self.close()
 
     def close(self):
         """
-            When it's all over, the run() function needs to know when to go home.
+            When it's all over, the parent needs to know when to go home.
         """
-        self.processqueue.put(False)
+        self.send(False)
 
     def stop(self):
         """
             Set status flag to error, which stops the remixing, terminates the child process and returns.
+            (The rest happens on the IOLoop, so this is safe to call from anywhere.)
         """
         print "Trying to stop remixer %s" % self.uid
         self.status = -1
+        self.ioloop.add_callback(self._done)
 
     def attach(self, callback): 
         """
@@ -187,70 +280,169 @@ class Remixer(Thread):
             Remove all temporary files, and clear unused memory.
             Remixin's a messy business.
         """
-        if path.isfile(self.tempfile):
-            unlink(self.tempfile)
+        if self.sink:
+            self.sink.abort()
+            self.sink = None
+        self.workspace.remove()
         if self.deleteOriginal and path.isfile(self.infile):
             unlink(self.infile)
-
-        i = 0
-        f = "%s%s%s.wav" % (self.tempdir, self.uid, i)
-        while path.isfile(f):
-            unlink(f)
-            i += 1
-            f = "%s%s%s.wav" % (self.tempdir, self.uid, i)
         if self.original:
             self.original.unload()
 
-    def run(self):
+    def start(self):
         """
-            Spawns a child process to do the actual remixing.
-            Blocks until a progress update comes from the child process.
-            When a progress update comes through:
-                if someone is watching (i.e.: there's a callback) then fire the callback
-                if not, put the progress update into a queue
-                if somebody is *monitoring* and doesn't care about missing an update,
-                  fire the monitors callback. (Useful for watching an entire server of remixers.)
-            The "loggers" callback gets fired on each update, no matter what.
+            Spawns a child process to do the actual remixing, and returns right away.
+            The child sends progress back over a pipe, which is watched by the Tornado IOLoop:
+            when a progress update comes through, _onProgress() runs on the loop's thread and
+            fires every callback (i.e.: the remixer's watcher, and the monitor) with it.
 
-            After remixing is complete and the communication queue is closed,
-            the subprocess is joined, deleted, and the parent's "finish" method
-            is called if it exists.
+            If a WorkerPool has been given (self.pool), the remix is sent to one of its
+            already-running workers instead, and progress comes back from that worker.
+
+            After remixing is complete and the pipe is closed (or the remix times out, or is stopped),
+            _done() reaps the subprocess, and the parent's "finish" method is called if it exists.
         """
         self.started = time.time()
         self.status = 1
-        self.processqueue = Queue()
-        self.p = Process(target=self._remix)                    #   Actual remix process started with Multiprocessing
-        self.p.start()
-
         self.last = None
+        self.state = {}
+        worker = self.pool.acquire() if self.pool else None
+        if worker:
+            self.p = worker
+            self.reader = self.p.submit(self).conn              #   Worker sends progress back on its own pipe
+        else:
+            self.pool = None                                    #   No pool, or all of its workers are busy
+            self.reader, self.conn = Pipe(False)
+            self.p = Process(target=self._remix)                #   Actual remix process started with Multiprocessing
+            self.p.start()
+            self.conn.close()                                   #   Only the child writes, so we see EOF if it dies
+            self.conn = None
+        self.alive = True
+        self.ioloop.add_handler(self.reader.fileno(), self._onProgress, self.ioloop.READ | self.ioloop.ERROR)
+        self._resetTimeout()
+        if config.resource_sample_interval:
+            self.sampler = Sampler(self.p.process.pid if self.pool else self.p.pid)
+            self._sample()
+
+    def _sample(self):
+        """
+            Samples the remix process' CPU time, memory and I/O (see helpers/procstats.py),
+            and schedules the next sample for as long as the remix is alive.
+        """
+        self.sampleTimer = None
+        if not self.alive or not self.sampler:
+            return
+        try:
+            self.sampler.sample()
+        except:
+            logging.getLogger().warning("Could not sample remix %s:\n%s" % (self.uid, traceback.format_exc()))
+        self.sampleTimer = self.ioloop.add_timeout(time.time() + config.resource_sample_interval, self._sample)
+
+    def _resetTimeout(self):
+        if self.timer:
+            self.ioloop.remove_timeout(self.timer)
+        self.timer = self.ioloop.add_timeout(time.time() + self.timeout, self._onTimeout)
+
+    def _onProgress(self, fd=None, events=None):
+        """
+            Reads every progress update waiting on the pipe, merges each one into the remix's state
+            (updates only carry the fields that changed), and passes the full state to the callbacks.
+            The child MUST END WITH a False value - anything else (i.e.: the child dying) counts as an error.
+        """
         try:
-            progress = self.processqueue.get(True, self.timeout)          #   Queue that blocks until progress updates happen
-            while progress and self.status is not -1:                       #   MUST END WITH False value, or else this will block forever
-                self.last = progress
-                for callback in self.callbacks:                             #   Send all progress updates
-                    callback(progress)
-                progress = self.processqueue.get(True, self.timeout)      #   Grab another progress update from the process
+            while self.alive and self.reader.poll():
+                progress = self.reader.recv()
+                if progress is False:
+                    self.completed = True
+                    break
+                self.state.update(progress)
+                self.last = dict(self.state)
+                for callback in self.callbacks:                 #   Send all progress updates
+                    callback(self.last)
+        except EOFError:
+            self.status = -1
+            self.handleError(Exception("RemixTermination: remix process went away."))
         except Exception, e:
             self.status = -1
             self.handleError(e)
+
+        if self.completed or self.status is -1:
+            self._done()
+        elif self.alive:
+            self._resetTimeout()
+
+    def _onTimeout(self):
+        self.timer = None
+        if self.alive:
+            self.status = -1
+            self.handleError(Exception("RemixTimeout: no progress in %s seconds." % self.timeout))
+            self._done()
+
+    def _done(self):
+        """
+            Stops listening to the child, reaps it, cleans up, and tells the parent we're finished.
+        """
+        if not self.alive:
+            return
+        self.alive = False
+        self.ioloop.remove_handler(self.reader.fileno())
+        if self.timer:
+            self.ioloop.remove_timeout(self.timer)
+            self.timer = None
+        if self.sampleTimer:
+            self.ioloop.remove_timeout(self.sampleTimer)
+            self.sampleTimer = None
+        if self.sampler:
+            try:
+                self.sampler.sample()   #   Once more before it's reaped, to catch the end of the remix
+                self.resources = self.sampler.totals()
+            except:
+                logging.getLogger().warning("Could not sample remix %s:\n%s" % (self.uid, traceback.format_exc()))
+            self.sampler = None
+        if self.status is -1 and not (self.last and 'debug' in self.last):
+            self.handleError(Exception("RemixTermination. Last was:\n%s" % self.last))
+        if self.pool:
+            #   The parent only hears we're done once the worker is ready for another remix,
+            #   so a queued remix that starts right away gets this worker rather than a cold one.
+            self.handingBack = True
+            self.pool.release(self.p, self.completed and self.status != -1, self._finished)
         else:
-            if self.status is -1:
-                try:
-                  self.handleError(Exception("RemixTermination. Last was:\n%s" % last))
-                except:
-                    self.handleError(Exception("RemixTermination"))
-        self.processqueue.close()
-        self.p.terminate()
+            self.reader.close()
+            self.p.terminate()
+            self.p.join()
+            self._finished()
+
+    def _finished(self):
+        self.handingBack = False
         self.cleanup()
         del self.p
         if hasattr(self.parent, 'finish'):
             self.parent.finish(self.uid, self.last)
 
+    def isAlive(self):
+        return self.alive or self.handingBack
+
+    def join(self, timeout=None):
+        """
+            Blocks until the remix is done, handling progress as it comes in.
+            For use without a running IOLoop (i.e.: from the command line).
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while self.alive:
+            wait = self.timeout if deadline is None else min(self.timeout, deadline - time.time())
+            if wait <= 0:
+                return
+            if self.reader.poll(wait):
+                self._onProgress()
+            elif deadline is None or time.time() < deadline:
+                self._onTimeout()
+
     def _remix(self):
         """
           Failure-tolerant wrapper around main remix method that allows for cleanup and such.
         """
         try:
+            self.samples.preload()
             self.tag['style'] = str(self.__class__.__name__)
             self.tag['remixed'] = self.remix()
             self.finish("Done!")
@@ -276,65 +468,203 @@ class Remixer(Thread):
 
     def mono_to_stereo(self, audio_data):
         """
-            Take in an AudioData with two channels,
-            return one with one. This here's a theivin' method.
+            Take in an AudioData with one channel,
+            return one with two. No Python lists, just one int16 copy.
         """
-        data = audio_data.data.flatten().tolist()
-        new_data = array((data,data))
-        audio_data.data = new_data.swapaxes(0,1)
-        audio_data.numChannels = 2
-        return audio_data
+        return audiobuffer.stereo(audio_data)
 
     def truncatemix(self, dataA, dataB, mix=0.5):
         """
-        Mixes two "AudioData" objects. Assumes they have the same sample rate
-        and number of channels.
+        Mixes two "AudioData" objects. Assumes they have the same sample rate.
         
         Mix takes a float 0-1 and determines the relative mix of two audios.
         i.e., mix=0.9 yields greater presence of dataA in the final mix.
 
         If dataB is longer than dataA, dataB is truncated to dataA's length.
+        (For more than two sources, use audiobuffer.mix directly - it's one pass either way.)
+        """
+        return audiobuffer.mix([(dataA, mix), (dataB, 1 - float(mix))])
+
+    def analyse(self):
+        """
+            Returns an audio.LocalAudioFile of the input file, complete with its Echo Nest analysis.
+            Analyses are cached on disk by the MD5 of the file, so if this exact song has been
+            remixed before, only the audio is decoded and the Echo Nest isn't asked again.
+
+            With config.memmap_source on, the audio is decoded to a raw file in the remix's workspace
+            and memory-mapped, rather than held in memory: only the parts that are actually used
+            get paged in, so memory use depends on the size of a section, not the length of the song.
+
+            If self.analysis_provider is set, the analysis comes from it instead, and isn't cached.
         """
-        newdata = audio.AudioData(ndarray=dataA.data, sampleRate=dataA.sampleRate,
-            numChannels=dataA.numChannels, defer=False, verbose=False)
-        newdata.data *= float(mix)
-        if dataB.endindex > dataA.endindex:
-            newdata.data[:] += dataB.data[:dataA.endindex] * (1 - float(mix))
+        memmap = config.memmap_source
+        original = None
+        if self.analysis_provider:
+            analysis = self.analysis_provider(self.infile)
         else:
-            newdata.data[:dataB.endindex] += dataB.data[:] * (1 - float(mix))
-        return newdata
+            if not self.hash:
+                self.hash = filehash(self.infile)
+            cache = AnalysisCache()
+            analysis = cache.get(self.hash)
+            if analysis is None:
+                original = audio.LocalAudioFile(self.infile, False, defer=memmap)
+                try:
+                    cache.put(self.hash, original.analysis)
+                except:
+                    logging.getLogger().warning("Could not cache analysis of %s:\n%s" % (self.uid, traceback.format_exc()))
+        if original is None:
+            #   Build the same object LocalAudioFile would, minus the trip to the Echo Nest.
+            original = audio.LocalAudioFile.__new__(audio.LocalAudioFile)
+            audio.AudioData.__init__(original, self.infile, verbose=False, defer=memmap)
+            original.analysis = analysis
+            analysis.source = original
+        if memmap:
+            self.sourcefile = self.workspace.path("%s.pcm" % self.uid, self.pcmBytes())
+            audiobuffer.attach(original, audiobuffer.decode(self.infile, self.sourcefile))
+        return original
+
+    def sample(self, name):
+        """
+            Returns one of this remixer's samples (a filename from the template)
+            as a read-only, memory-mapped AudioData, shared with every other remix.
+        """
+        return self.samples.get(name)
+
+    def render(self, plan, cache=None):
+        """
+            Renders a RenderPlan against this remix's original song and samples, into one AudioData.
+            Pieces of the original are stretched with self.st (or a new FastModify).
+            Pass a dict as cache to reuse stretched pieces between plans.
+        """
+        return self.renderer(cache).render(self.logPlan(plan))
+
+    def renderer(self, cache=None):
+        """
+            A Renderer for this remix. Use its stream() method (on a plan passed through logPlan())
+            to render a long plan - i.e.: a whole song - a few seconds at a time.
+        """
+        return Renderer(self.original, self.samples, getattr(self, 'st', None) or FastModify(workspace=self.workspace), cache)
+
+    def logPlan(self, plan):
+        """
+            Writes a plan to self.planlog, if it's set. Returns the plan.
+        """
+        if self.planlog:
+            self.planlog.write(plan.dump() + "\n\n")
+        return plan
+
+    def sectionWorkers(self, count):
+        """
+            How many processes to render sections with: at most config.section_workers,
+            and no more than this remix's share of the machine's cores.
+        """
+        share = max(1, cpu_count() / max(1, config.maximum_concurrent_remixes))
+        return max(1, min(config.section_workers, share, count))
+
+    def mapSections(self, method, arglist):
+        """
+            Calls the named method once for each tuple of arguments in arglist,
+            and yields the results in order. Each result must be an AudioData or a tuple of them.
+
+            Sections only depend on the analysis and the samples, so if more than one
+            worker is allowed, they're rendered on a pool of processes forked from this one,
+            and reassembled in order here. Results stream back as they're done,
+            so the caller can partialEncode() each one while the rest are still rendering.
+            Each worker's latest sectionStats() are kept in self.workerStats, by pid.
+        """
+        global _sections
+        workers = self.sectionWorkers(len(arglist))
+        if workers < 2:
+            for args in arglist:
+                yield getattr(self, method)(*args)
+            return
+
+        _sections = (self, method, arglist)
+        pool = Pool(workers)
+        _sections = None
+        try:
+            for wrapped, parts, pid, stats in pool.imap(_renderSection, xrange(len(arglist))):
+                self.workerStats[pid] = stats
+                parts = tuple([audiobuffer.view(data, sampleRate) for data, sampleRate in parts])
+                yield parts if wrapped else parts[0]
+            pool.close()
+        finally:
+            pool.terminate()
+
+    def sectionStats(self):
+        """
+            Stats that a section pool worker sends back with each section it renders,
+            as its own copy of the remixer's state isn't seen by the remix process otherwise.
+        """
+        return {}
+
+    def openSink(self, sampleRate=44100, numChannels=2):
+        """
+            Opens the output that partialEncode() streams the remix into.
+            With stream_encoding on, that's LAME itself, writing straight to self.outfile.
+            Otherwise it's a WAV file at self.tempfile, to be run through LAME by master().
+        """
+        if config.stream_encoding:
+            return LameSink(self.outfile, sampleRate, numChannels)
+        self.tempfile = self.workspace.path("%s.wav" % self.uid, self.pcmBytes(sampleRate, numChannels))
+        return WavSink(self.tempfile, sampleRate, numChannels)
+
+    def pcmBytes(self, sampleRate=44100, numChannels=2):
+        """
+            Rough size of the song as 16-bit PCM, from its tag's length - or 0 if that isn't known yet
+            (which keeps the file off the tmpfs, as it could grow to any size).
+            Remixes come out about as long as the song they're made from, so this sizes their WAVs too.
+        """
+        try:
+            return int((self.tag.get('length') or 0) * sampleRate * numChannels * 2)
+        except (TypeError, ValueError):
+            return 0
 
     def partialEncode(self, audiodata):
         """
             A neat alternative to AudioQuantumList.
             Instead of making a list, holding it in memory and encoding it all at once,
-            each element in the list is encoded upon addition.
+            each element in the list is appended to one open WAV file (self.tempfile)
+            upon addition, and its samples are freed right away.
 
             After many partialEncode()s, the mixwav() function should be called,
-            which calls shntool on the command line for super-fast audio concatenation.
+            which finishes off that WAV file, or master(), which finishes off the MP3.
         """
-        audiodata.encode("%s%s%03d.wav" % (self.tempdir, self.uid, self.encoded))
+        if not self.sink:
+            self.sink = self.openSink(audiodata.sampleRate)
+        self.sink.write(audiodata)
         audiodata.verbose = False
         audiodata.unload()
         self.encoded += 1
 
     def mixwav(self, filename):
         """
-            When used after partialEncode(), this concatenates a number of audio
-            files into one with a given filename. (Super fast, super memory-efficient.)
-            
-            Requires the shntool binary to be installed.
+            When used after partialEncode(), this closes the WAV file that's been
+            appended to (patching its header) and moves it to the given filename.
+            Each sample only hits the disk once, and no external binaries are needed.
         """
-        if self.encoded is 1:
-            rename("%s%s%03d.wav" % (self.tempdir, self.uid, 0), filename)
-            return
-        args = ['shntool', 'join', '-z', self.uid, '-q', '-d', self.tempdir]
-        for i in xrange(0, self.encoded):
-            args.append("%s%s%03d.wav" % (self.tempdir, self.uid, i))
-        call(args)
-        rename("%sjoined%s.wav" % (self.tempdir, self.uid), filename)
-        for i in xrange(0, self.encoded):
-            unlink("%s%s%03d.wav" % (self.tempdir, self.uid, i))
+        if not self.sink:
+            raise Exception("Nothing has been encoded yet!")
+        if isinstance(self.sink, LameSink):
+            raise Exception("Can't mix to WAV when streaming straight to LAME.")
+        self.sink.close()
+        if self.sink.filename != filename:
+            rename(self.sink.filename, filename)
+        self.sink = None
+
+    def master(self):
+        """
+            Finishes off everything given to partialEncode(), leaving an MP3 at self.outfile.
+            When streaming, LAME has been encoding all along, so this just waits for it to finish.
+            Otherwise, the intermediate WAV is closed, run through LAME and deleted.
+        """
+        if isinstance(self.sink, LameSink):
+            self.sink.close()
+            self.sink = None
+        else:
+            self.mixwav(self.tempfile)
+            self.lame(self.tempfile, self.outfile)
+            unlink(self.tempfile)
 
     """
     Metadata methods for tagging
@@ -423,7 +753,7 @@ class Remixer(Thread):
                 ext = mimetypes.guess_extension(imgmime)
                 if not ext:
                     raise Exception("Unknown artwork format!")
-                artname = path.join(self.tempdir, "%s%s" % (self.uid, ext))
+                artname = self.workspace.path("%s%s" % (self.uid, ext), len(imgdata))
                 self.artpath = path.join(self.outdir, "%s%s" % (self.uid, ext))
                 self.thumbpath = path.join(self.outdir, "%s.thumb%s" % (self.uid, ext))
 
@@ -472,7 +802,8 @@ class Remixer(Thread):
 
             outtag = File(self.outfile)  
             outtag.add_tags()
-            outtag.tags.add(id3.TBPM(encoding=0, text=unicode(self.template['tempo'])))
+            if self.tag.get('tempo'):
+                outtag.tags.add(id3.TBPM(encoding=0, text=unicode(self.tag['tempo'])))
             if self.extension == ".mp3":
                 for k, v in self.mt.iteritems():
                     if k != 'APIC:':
@@ -512,17 +843,31 @@ class Remixer(Thread):
         except:
             pass
 
+    def segmentIndex(self, segments):
+        """
+            Returns a SegmentIndex for a list of segments (a.k.a: song.analysis.segments),
+            building it only the first time it's asked for.
+        """
+        if self.index is None or self.index.segments is not segments:
+            self.index = SegmentIndex(segments)
+        return self.index
+
     def loudness(self, segments, bar):
         """
             Given a list of segments (a.k.a: song.analysis.segments) and a bar,
             calculate the average loudness of the bar.
         """
-        b = segments.that(overlap_range(bar[0].start, bar[len(bar)-1].end))
-        maximums = [x.loudness_max for x in b]
-        if len(maximums):   
-            return float(sum(maximums) / len(maximums))
-        else:
-            return None
+        return self.segmentIndex(segments).loudness(bar[0].start, bar[len(bar)-1].end)
+
+    def loudnesses(self, segments, bars):
+        """
+            Same as loudness(), for a whole list of bars in one go.
+            Returns a numpy array, with NaN for bars that don't overlap any segments.
+        """
+        return self.segmentIndex(segments).loudness_for_ranges(
+            [bar[0].start for bar in bars],
+            [bar[len(bar)-1].end for bar in bars]
+        )
 
 
 class CMDRemix():
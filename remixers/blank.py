@@ -13,7 +13,7 @@ class Blank(Remixer):
     def remix(self):
         """
             Remixing happens here. Take your input file from self.infile and write your remix to self.outfile.
-            If necessary, self.tempfile can be used for temp files. 
+            If necessary, temp files can go in self.workspace.path(name) - they are removed when the remix ends.
         """
         open(self.outfile, 'w').write(open(self.infile).read())
 
@@ -2,15 +2,17 @@
 doubletime.py
 
 Double-speed remix template.
+The song is decoded, stretched and encoded a chunk at a time (config.doubletime_chunk_seconds),
+so memory use stays the same however long the upload is.
 Dependencies:
-    FastModify
     Remixer
+    en-ffmpeg (command line binary, comes with the Remix API)
     lame (command line binary)
-    soundstretch (command line binary)
+    soundstretch (command line binary, only if time_stretch_engine is "soundstretch")
 """
 
 from remixer import *
-from fastmodify import FastModify
+from helpers import audiobuffer, timestretch
 
 class DoubleTime(Remixer):
     speedFactor = 2
@@ -19,26 +21,29 @@ class DoubleTime(Remixer):
             Remixing happens here. Take your input file from self.infile and write your remix to self.outfile.
             Be sure to .unload() all of your read-in audioData objects to conserve memory.
         """
-        # Use the Echo Nest Remix API to open the audio file
-        a = audio.AudioData(self.infile)
-
         # Tell somebody about our progress (add 25%)
         self.log("Shifting tempo...", 25)
 
-        # Use FastModify (a fork of echonest.Modify that uses soundstretch) to stretch beats
-        FastModify().shiftTempo(a, self.speedFactor).encode(self.tempfile)
-
-        self.log("Cleaning up...", 25)
-
-        # Remove temporary file auto-generated by the Echo Nest Remix API
-        a.unload() 
-
-        self.log("Encoding MP3...", 25)
-
-        # Encode the temporary file into the output file
-        self.lame(self.tempfile, self.outfile)
+        # Stretch the song as it's decoded. With soundstretch, each chunk is shifted on its own;
+        # otherwise an in-process WSOLA stretcher carries its overlap from one chunk over to the next
+        chunks = audiobuffer.stream(self.infile, config.doubletime_chunk_seconds)
+        if config.time_stretch_engine == "soundstretch":
+            st = FastModify(workspace=self.workspace)
+            for chunk in chunks:
+                self.partialEncode(st.shiftTempo(audiobuffer.view(chunk), self.speedFactor))
+        else:
+            stretcher = timestretch.Stretcher(self.speedFactor, 2)
+            for chunk in chunks:
+                shifted = stretcher.feed(chunk)
+                if len(shifted):
+                    self.partialEncode(audiobuffer.view(shifted))
+            self.partialEncode(audiobuffer.view(stretcher.flush()))
+
+        self.log("Encoding MP3...", 50)
+
+        # Finish off the output file
+        self.master()
+        return self.outfile
 
 if __name__ == "__main__":
     CMDRemix(DoubleTime)
-
-
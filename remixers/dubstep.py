@@ -7,7 +7,6 @@ Dependencies:
     FastModify
     Remixer
     lame (command line binary)
-    shntool (command line binary)
     soundstretch (command line binary)
 
 by Peter Sobot <hi@petersobot.com>
@@ -18,6 +17,10 @@ based off of code by Ben Lacker, 2009-02-24.
 
 from remixer import Remixer, CMDRemix
 from helpers.fastmodify import FastModify
+from helpers import audiobuffer
+from helpers.analysisindex import PitchIndex
+from helpers.renderplan import RenderPlan
+import numpy
 
 from os import unlink
 from echonest.selection import *
@@ -33,7 +36,7 @@ class Dubstep(Remixer):
         A couple custom modifications to the Remix API:
             FastModify is used instead of Modify, which requires the `soundstretch` binary to be installed.
             Remixer.partialEncode() and Remixer.mixwav() are used instead of an AudioQuantumList,
-            to save memory and increase processing speed at the expense of disk space. (Requires `shntool` binary.)
+            to save memory and increase processing speed by streaming each section into one WAV file.
             
     """
     template = {
@@ -110,13 +113,9 @@ class Dubstep(Remixer):
     def getSamples(self, section, pitch, target="beats"):
         """
             The EchoNest-y workhorse. Finds all beats/bars in a given section, of a given pitch.
+            (Looked up in a PitchIndex built once per song, rather than filtering every segment each time.)
         """
-        sample_list = audio.AudioQuantumList()
-        if target == "beats":
-            sample_list.extend([b for x in section.children() for b in x.children()]);
-        elif target == "bars":
-            sample_list.extend(section.children())
-        return sample_list.that(overlap_ends_of(self.original.analysis.segments.that(have_pitch_max(pitch)).that(overlap_starts_of(sample_list))))
+        return self.pitches.get(section, pitch, target)
 
     def mixfactor(self, segment):
         """
@@ -124,21 +123,31 @@ class Dubstep(Remixer):
             Mixfactor returned:
               1: full wub
               0: full original
-            Result can be fed into echonest.audio.mix() as the third parameter.
+            Result is used as the gain of the wubs in audiobuffer.mix().
+        """
+        return self.mixfactors([segment])[0]
+
+    def mixfactors(self, segments):
+        """
+            Computes the mixfactor of a whole list of segments (i.e.: every section's bar) at once.
         """
-        mixfactor = 0
         a = (89.0/1.5) + self.template['mixpoint']
         b = (188.0/1.5) + self.template['mixpoint']
-        loud = self.loudness(self.original.analysis.segments, segment)
-        if not loud:
-            loud = self.original.analysis.loudness
-        if loud != -1 * b:
-            mixfactor = float(float(loud + a)/float(loud + b))
-        if mixfactor > 0.8:
-            mixfactor = 0.8
-        elif mixfactor < 0.3:
-            mixfactor = 0.3
-        return mixfactor
+        loud = self.loudnesses(self.original.analysis.segments, segments)
+        loud[numpy.isnan(loud) | (loud == 0)] = self.original.analysis.loudness
+        mixfactor = numpy.zeros(len(loud))
+        valid = loud != -1 * b
+        mixfactor[valid] = (loud[valid] + a) / (loud[valid] + b)
+        return [float(m) for m in mixfactor.clip(0.3, 0.8)]
+
+    def tempoRatio(self, spans):
+        """
+            Tempo ratio that beats of the original (as audiobuffer.bounds() spans) are stretched by.
+            If song is not 4/4, the 16 beats are stretched to fit 16 beats of the template instead.
+        """
+        if self.original.analysis.time_signature == 4:
+            return self.template['tempo']/self.tempo
+        return sum([end - start for start, end in spans]) / ((44100 * 16 * 2 * 60.0)/self.template['tempo'])
 
     def compileIntro(self):
         """
@@ -155,7 +164,7 @@ class Dubstep(Remixer):
                 third beat of 4th bar x 8   (sixteenth notes)
         """
         out = audio.AudioQuantumList()
-        intro = audio.AudioData(self.sample_path + self.template['intro'], sampleRate=44100, numChannels=2, verbose=False)
+        intro = self.template['intro']
         
         #   First 4 bars of song
         custom_bars = []
@@ -174,7 +183,7 @@ class Dubstep(Remixer):
         else:
             for i in xrange(0, 4):
                 custom_bars.append(self.beats[i*4:(i*4)+4])
-        out.extend([x for bar in custom_bars for x in bar])
+        out.extend([x for b in custom_bars for x in b])
 
         #   First beat of first bar x 4
         for i in xrange(0, 4):
@@ -200,37 +209,26 @@ class Dubstep(Remixer):
         for x in xrange(0, 8):
             out.append(audio.AudioQuantum(beatthree.start, beatthree.duration/4, None, beatthree.confidence, beatthree.source))
         
-        if self.original.analysis.time_signature == 4:
-            shifted = self.st.shiftTempo(audio.getpieces(self.original, out), self.template['tempo']/self.tempo)
-        else:
-            shifted1 = audio.getpieces(self.original, out)
-            shifted = self.st.shiftTempo(shifted1, len(shifted1) / ((44100 * 16 * 2 * 60.0)/self.template['tempo']))
-            shifted1.unload()
-        if shifted.numChannels == 1:    
-            shifted = self.mono_to_stereo(shifted)
-        return self.truncatemix(intro, shifted, self.mixfactor(out))
-
-    def compileSection(self, j, section, hats):
+        mixfactor = self.mixfactor(out)
+        spans = audiobuffer.bounds(self.original, out)
+        plan = RenderPlan(len(self.sample(intro)))
+        plan.sample(intro, gain=mixfactor)
+        plan.group(spans, ratio=self.tempoRatio(spans), gain=1 - mixfactor)
+        return self.render(plan)
+
+    def arrangeSection(self, j):
         """
-            Compiles one "section" of dubstep - that is, one section (verse/chorus) of the original song,
-            but appropriately remixed as dubstep.
-
-            Chooses appropriate samples from the section of the original song in three keys (P1, m3, m7)
-            then plays them back in order in the generic "dubstep" pattern (all 8th notes):
+            Chooses appropriate samples from section j of the original song in three keys (P1, m3, m7)
+            then lays them out in the generic "dubstep" pattern (all 8th notes):
 
             |                         |                         :|
             |: 1  1  1  1  1  1  1  1 | m3 m3 m3 m3 m7 m7 m7 m7 :| x2
             |                         |                         :|
 
-            On the first iteration, the dubstep bar is mixed with a "splash" sound - high-passed percussion or whatnot.
-            On the second iteration, hats are mixed in on the offbeats and the wubs break on the last beat to let the
-            original song's samples shine through for a second, before dropping back down in the next section.
-
             If samples are missing of one pitch, the searchSamples algorithm tries to find samples
             a fifth from that pitch that will sound good. (If none exist, it keeps trying, in fifths up the scale.)
-            
-            If the song is not 4/4, the resulting remix is sped up or slowed down by the appropriate amount.
-            (That can get really wonky, but sounds cool sometimes, and fixes a handful of edge cases.)
+
+            Returns the bar as an AudioQuantumList - nothing is rendered yet.
         """
         onebar = audio.AudioQuantumList()
 
@@ -268,46 +266,40 @@ class Dubstep(Remixer):
                 onebar.append( s2[i % len(s2)] )
             for i in xrange(6*f, 8*f):
                 onebar.append( s3[i % len(s3)] )
-        if self.original.analysis.time_signature == 4:
-            orig_bar = self.st.shiftTempo(audio.getpieces(self.original, onebar), self.template['tempo']/self.tempo)
-        else:
-            orig_bar = audio.getpieces(self.original, onebar)
-            orig_bar = self.st.shiftTempo(orig_bar, len(orig_bar) / ((44100 * 16 * 2 * 60.0)/self.template['tempo']))
-        if orig_bar.numChannels == 1:
-            orig_bar = self.mono_to_stereo(orig_bar)
-        mixfactor = self.mixfactor(onebar)
-        a = self.truncatemix(
-                audio.mix(
-                    audio.AudioData(
-                        self.sample_path + self.template['wubs'][self.tonic], 
-                        sampleRate=44100,
-                        numChannels=2,
-                        verbose=False
-                    ),
-                    audio.AudioData(
-                        self.sample_path + self.template['splashes'][(j+1) % len(self.template['splashes'])],
-                        sampleRate=44100,
-                        numChannels=2,
-                        verbose=False
-                    )
-                ),
-            orig_bar,
-            mixfactor
-        )
-        b = self.truncatemix(
-                audio.mix(
-                    audio.AudioData(
-                        self.sample_path + self.template['wub_breaks'][self.tonic],
-                        sampleRate=44100,
-                        numChannels=2,
-                        verbose=False
-                    ),
-                    hats
-                ),
-            orig_bar,
-            mixfactor
-        )
-        return (a, b)
+        return onebar
+
+    def compileSection(self, j, section, onebar=None, mixfactor=None):
+        """
+            Compiles one "section" of dubstep - that is, one section (verse/chorus) of the original song,
+            but appropriately remixed as dubstep.
+
+            Plays back the bar chosen by arrangeSection() twice (pass in onebar and its mixfactor if they're already known):
+            On the first iteration, the dubstep bar is mixed with a "splash" sound - high-passed percussion or whatnot.
+            On the second iteration, hats are mixed in on the offbeats and the wubs break on the last beat to let the
+            original song's samples shine through for a second, before dropping back down in the next section.
+            
+            If the song is not 4/4, the resulting remix is sped up or slowed down by the appropriate amount.
+            (That can get really wonky, but sounds cool sometimes, and fixes a handful of edge cases.)
+        """
+        if onebar is None:
+            onebar = self.arrangeSection(j)
+        if mixfactor is None:
+            mixfactor = self.mixfactor(onebar)
+        spans = audiobuffer.bounds(self.original, onebar)
+        ratio = self.tempoRatio(spans)
+        plans = []
+        for wubs, percussion in [
+                (self.template['wubs'][self.tonic], self.template['splashes'][(j+1) % len(self.template['splashes'])]),
+                (self.template['wub_breaks'][self.tonic], self.template['hats'])
+            ]:
+            #   Same as truncatemix(audio.mix(wubs, percussion), orig_bar, mixfactor)
+            plan = RenderPlan(max(len(self.sample(wubs)), len(self.sample(percussion))))
+            plan.sample(wubs, gain=0.5 * mixfactor)
+            plan.sample(percussion, gain=0.5 * mixfactor)
+            plan.group(spans, ratio=ratio, gain=1 - mixfactor)
+            plans.append(plan)
+        cache = {}  #   Both halves play the same bar, so it's only stretched once.
+        return tuple([self.render(p, cache) for p in plans])
 
     def remix(self):
         """
@@ -318,10 +310,10 @@ class Dubstep(Remixer):
         self.processArt()
 
         self.log("Listening to %s..." % ('"%s"' % self.tag['title'] if 'title' in self.tag else 'song'), 5)
-        self.original = audio.LocalAudioFile(self.infile, False)
+        self.original = self.analyse()
         if not 'title' in self.tag:
             self.detectSong(self.original)
-        self.st = FastModify()
+        self.st = FastModify(workspace=self.workspace)
         
         self.log("Choosing key and tempo...", 10)
         self.tonic = self.original.analysis.key['value']
@@ -329,47 +321,40 @@ class Dubstep(Remixer):
         self.bars = self.original.analysis.bars
         self.beats = self.original.analysis.beats
         self.sections = self.original.analysis.sections
+        self.pitches = PitchIndex(self.segmentIndex(self.original.analysis.segments))
         self.tag['key'] = self.keys[self.tonic] if self.tonic >= 0 and self.tonic < 12 else '?'
         self.tag['tempo'] = self.template['tempo']
 
         self.log("Arranging intro...", 40.0/(len(self.sections) + 1))
         self.partialEncode(self.compileIntro())
 
-        past_progress = 0
-        hats  = audio.AudioData(self.sample_path + self.template['hats'], sampleRate=44100, numChannels=2, verbose=False)
+        self.log("Finding each section's bars...", 5)
+        bars = [self.arrangeSection(i) for i in xrange(len(self.sections))]
+        mixfactors = self.mixfactors(bars)
 
         i = 0 # Required if there are no sections
-        for i, section in enumerate(self.sections):
+        sections = iter(self.mapSections('compileSection', [(n, section, bars[n], mixfactors[n]) for n, section in enumerate(self.sections)]))
+        for i in xrange(len(self.sections)):
+            #   Logged before each section is rendered, so its time counts towards its own stage
             self.log("Arranging section %s of %s..." % (i+1, len(self.sections)), 40.0/(len(self.sections) + 1))
-            a, b = self.compileSection(i, section, hats)
+            a, b = next(sections)
             self.partialEncode(a)
             self.partialEncode(b)
             del a, b
-        del hats
+        sections.close()     #   Lets the section pool, if any, shut down
         self.original.unload()
 
         self.log("Adding ending...", 5)
-        self.partialEncode(
-            audio.AudioData(
-                self.sample_path + self.template['splash_ends'][(i + 1) % len(self.template['splash_ends'])],
-                sampleRate=44100,
-                numChannels=2,
-                verbose=False
-            )
-        )
+        self.partialEncode(self.sample(self.template['splash_ends'][(i + 1) % len(self.template['splash_ends'])]))
         
-        self.log("Mixing...", 5)
-        self.mixwav(self.tempfile)
-
         if self.deleteOriginal:
             try:
                 unlink(self.infile)
             except:
                 pass  # File could have been deleted by an eager cleanup script
 
-        self.log("Mastering...", 5)
-        self.lame(self.tempfile, self.outfile)
-        unlink(self.tempfile)
+        self.log("Mastering...", 10)
+        self.master()
         
         self.log("Adding artwork...", 20)
         self.updateTags(titleSuffix = " (Wub Machine Remix)")
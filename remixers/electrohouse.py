@@ -7,7 +7,6 @@ Dependencies:
     FastModify
     Remixer
     lame (command line binary)
-    shntool (command line binary)
     soundstretch (command line binary)
 
 by Peter Sobot <hi@petersobot.com>
@@ -18,82 +17,18 @@ based off of code by Ben Lacker, 2009-02-24.
 
 from remixer import *
 from helpers.fastmodify import FastModify
-from echonest.modify import Modify
-from echonest.action import make_stereo
+from helpers import audiobuffer
+from helpers.analysisindex import PitchIndex
+from helpers.renderplan import RenderPlan
+from helpers.lru import LRUCache, combine
 import numpy
 
 tempo = 128.0
 
-# Audio Division
-def half_of(audioData):
-    return divide(audioData, 2)[0]
-
-def third_of(audioData):
-    return divide(audioData, 3)[0]
-
-def quarter_of(audioData):
-    return divide(audioData, 4)[0]
-
-def eighth_of(audioData):
-    return divide(audioData, 8)[0]
-
-def eighth_triplet(audioData):
-    return cutnote(audioData, 6)
-
-def quarter_triplet(audioData):
-    return cutnote(audioData, 3)
-
-def sixteenth_note(audioData):
-    return cutnote(audioData, 4)
-
-def eighth_note(audioData):
-    return cutnote(audioData, 2)
-
-def dotted_eighth_note(audioData):
-    return cutnote(audioData, 0.75)
-
-def quarter_note(audioData):
-    return cutnote(audioData, 1)
-    
-def cutnote(audioData, length):
-    beatlength = (audioData.sampleRate * 60 / tempo) #in samples
-    i = beatlength/length
-    data = audioData.data[0:i]
-    if len(data) < i:
-        if audioData.numChannels == 2:
-            shape = (i - len(data),2)
-        else:
-            shape = (i - len(data),)
-        data = numpy.append(data, numpy.zeros(shape, dtype=numpy.int16), 0)
-    r = audio.AudioData(
-        ndarray=data,
-        numChannels=audioData.numChannels,
-        sampleRate = audioData.sampleRate
-    )
-    return make_stereo(r) if (r.numChannels == 1) else r
-
-def divide(audioData, by):
-    return [audio.AudioData(
-        ndarray=audioData.data[i:len(audioData.data)/by],
-        numChannels=audioData.numChannels,
-        sampleRate = audioData.sampleRate
-    ) for i in xrange(0, len(audioData.data), len(audioData.data)/by)]
-
-quarter_rest = audio.AudioData(ndarray=numpy.zeros(         ((44100 * 60 / tempo), 2),      dtype=numpy.int16), numChannels=2, sampleRate=44100)
-eighth_rest = audio.AudioData(ndarray=numpy.zeros(          ((44100 * 60 / tempo)/2, 2),    dtype=numpy.int16), numChannels=2, sampleRate=44100)
-dotted_eighth_rest = audio.AudioData(ndarray=numpy.zeros(   ((44100 * 60 / tempo)/0.75, 2), dtype=numpy.int16), numChannels=2, sampleRate=44100)
-quarter_triplet_rest = audio.AudioData(ndarray=numpy.zeros( ((44100 * 60 / tempo)/3, 2),    dtype=numpy.int16), numChannels=2, sampleRate=44100)
-sixteenth_rest = audio.AudioData(ndarray=numpy.zeros(       ((44100 * 60 / tempo)/4, 2),    dtype=numpy.int16), numChannels=2, sampleRate=44100)
-
-rhythm_map = {1: sixteenth_note, 2: eighth_note, 3: dotted_eighth_note, 4: quarter_note}
-rest_map = {1: sixteenth_rest, 2: eighth_rest, 3: dotted_eighth_rest, 4: quarter_rest}
-
 class note():
   def __init__(self, pitch=None, length=1):
         self.pitch = pitch
         self.length = length
-        self.data = rest_map[length]
-        self.function = rhythm_map[length]
   def __repr__(self):
         return "%s x 16th note %s" % (self.length, self.pitch if self.pitch is not None else "rest")
 
@@ -122,6 +57,34 @@ def readPattern(filename):
             bar.append(note(int(sixteenth)))
     return bar
 
+notelengths = {1: 4, 2: 2, 3: 0.75, 4: 1}    # Fractions of a beat, by note length in sixteenths
+
+class pattern():
+  """
+        A pattern file, parsed once and compiled into arrays - one entry per note or rest.
+        pitches: interval from the tonic, or -1 for a rest
+        lengths, starts: length and position of each note in the section, in samples
+  """
+  def __init__(self, filename):
+        notes = readPattern(filename)
+        self.pitches = numpy.array([-1 if n.pitch is None else n.pitch for n in notes], dtype=numpy.int32)
+        self.lengths = numpy.array([int((44100 * 60 / tempo)/notelengths[n.length]) for n in notes], dtype=numpy.int64)
+        self.starts = numpy.concatenate(([0], numpy.cumsum(self.lengths)[:-1])).astype(numpy.int64)
+        self.notes = numpy.flatnonzero(self.pitches >= 0)   # Indices of the notes that aren't rests
+        self.length = int(self.lengths.sum())
+  def __len__(self):
+        return len(self.pitches)
+
+patterns = {}
+
+def compilePattern(filename):
+    """
+        Returns the compiled pattern for a pattern file. Each file is only read once per process.
+    """
+    if not filename in patterns:
+        patterns[filename] = pattern(filename)
+    return patterns[filename]
+
 class ElectroHouse(Remixer):
     template = {
         'tempo':        128,
@@ -152,59 +115,45 @@ class ElectroHouse(Remixer):
                         ],
     }
     st = None
-    sampleCache = {}
 
     def searchSamples(self, j, key):
         """
             Find all samples (beats) of a given key in a given section.
         """
-        hashkey = "_%s-%s" % (j, key)
-        if not hashkey in self.sampleCache:
-            if self.sections:
-                pool = self.sections[j % len(self.sections)]
-            elif self.original.analysis.bars:
-                pool = self.original.analysis.bars
-            elif self.original.analysis.segments:
-                pool = self.original.analysis.segments
-            else:
-                raise Exception("No samples found for section %s." % j+1)
+        if self.sections:
+            pool = self.sections[j % len(self.sections)]
+        elif self.original.analysis.bars:
+            pool = self.original.analysis.bars
+        elif self.original.analysis.segments:
+            pool = self.original.analysis.segments
+        else:
+            raise Exception("No samples found for section %s." % j+1)
+        a = self.getSamples(pool, key)
+        for tries in xrange(0, 5):
+            if len(a):
+                break
+            key = (key + 7) % 12
             a = self.getSamples(pool, key)
+        else:
             for tries in xrange(0, 5):
                 if len(a):
                     break
-                key = (key + 7) % 12
+                if self.sections:
+                    j = (j + 1) % len(self.sections)
+                elif self.original.analysis.bars:
+                    j = (j + 1) % len(self.original.analysis.bars)
+                elif self.original.analysis.segments:
+                    j = (j + 1) % len(self.original.analysis.segments)
+                key = (key + 2) % 12
                 a = self.getSamples(pool, key)
-            else:
-                for tries in xrange(0, 5):
-                    if len(a):
-                        break
-                    if self.sections:
-                        j = (j + 1) % len(self.sections)
-                    elif self.original.analysis.bars:
-                        j = (j + 1) % len(self.original.analysis.bars)
-                    elif self.original.analysis.segments:
-                        j = (j + 1) % len(self.original.analysis.segments)
-                    key = (key + 2) % 12
-                    a = self.getSamples(pool, key)
-            self.sampleCache[hashkey] = a
-        return self.sampleCache[hashkey]
+        return a
 
     def getSamples(self, section, pitch, target="beats"):
         """
             The EchoNest-y workhorse. Finds all beats/bars in a given section, of a given pitch.
+            (Looked up in a PitchIndex built once per song, rather than filtering every segment each time.)
         """
-        hashkey = "__%s.%s" % (str(section), pitch)
-        if not hashkey in self.sampleCache:
-            sample_list = audio.AudioQuantumList()
-            if target == "beats":
-                try:
-                    sample_list.extend([b for x in section.children() for b in x.children()])
-                except:
-                    sample_list.extend(section)
-            elif target == "bars":
-                sample_list.extend(section.children())
-            self.sampleCache[hashkey] = sample_list.that(overlap_ends_of(self.original.analysis.segments.that(have_pitch_max(pitch)).that(overlap_starts_of(sample_list))))
-        return self.sampleCache[hashkey]
+        return self.pitches.get(section, pitch, target)
 
     def mixfactor(self, segment):
         """
@@ -228,63 +177,44 @@ class ElectroHouse(Remixer):
             mixfactor = 0.3
         return mixfactor
 
+    def arrange(self, filename, section, backing):
+        """
+            Lays a pattern file out as a RenderPlan over one of the template's backing samples.
+            Each note is a beat of the original of that pitch (from the given section),
+            stretched to the template's tempo and cut to the note's length.
+        """
+        compiled = compilePattern(filename)
+        plan = RenderPlan(len(self.sample(backing)))
+        plan.sample(backing, gain=0.3)
+        ratio = self.template['tempo']/self.tempo
+        found = {}
+        for pitch in numpy.unique(compiled.pitches[compiled.notes]):
+            found[pitch] = self.searchSamples(section, (int(pitch) + self.tonic) % 12)
+        for i in compiled.notes:
+            samples = found[compiled.pitches[i]]
+            if samples:
+                spans = audiobuffer.bounds(self.original, [samples[i % len(samples)]])
+                plan.group(spans, start=int(compiled.starts[i]), ratio=ratio, gain=0.7, limit=int(compiled.lengths[i]))
+        return plan
+
     def compileIntro(self, section=0, intro=None):
         if not intro:
-            intro = audio.AudioData(self.sample_path + self.template['intro'], sampleRate=44100, numChannels=2, verbose=False)
-        out = audio.AudioQuantumList()
-        section_hash_keys = []
-
-        for i, item in enumerate(readPattern('samples/electrohouse/intro.txt')):
-            if item.pitch is None:
-                out.append(item.data)
-            else:
-                samples = self.searchSamples(section, (item.pitch + self.tonic) % 12) 
-                if not samples:
-                    out.append(item.data)
-                else:
-                    hash_key = str(samples[i%len(samples)])
-                    if not hash_key in self.sampleCache:
-                        self.sampleCache[hash_key] = self.st.shiftTempo(samples[i%len(samples)].render(), self.template['tempo']/self.tempo)
-                        section_hash_keys.append(hash_key)
-                    out.append(
-                      item.function(
-                        self.sampleCache[hash_key]
-                      )
-                    )
-        shifted = audio.assemble(out, numChannels = 2)
-        if shifted.numChannels == 1:    
-            shifted = self.mono_to_stereo(shifted)
-        for hash_key in section_hash_keys:
-            del self.sampleCache[hash_key]
-        return self.truncatemix(intro, shifted, 0.3)
+            intro = self.template['intro']
+        return self.render(self.arrange('samples/electrohouse/intro.txt', section, intro), self.stretched)
 
     def compileSection(self, j, section, backing):
-        out = audio.AudioQuantumList()
-        section_hash_keys = []
+        return self.render(self.arrange('samples/electrohouse/section.txt', j, backing), self.stretched)
+
+    def sectionStats(self):
+        return {'stretch_cache': self.stretched.stats()}
 
-        for i, item in enumerate(readPattern('samples/electrohouse/section.txt')):
-            if item.pitch is None:
-                out.append(item.data)
-            else:
-                samples = self.searchSamples(j, (item.pitch + self.tonic) % 12)
-                if not samples:
-                    out.append(item.data)
-                else:
-                    hash_key = str(samples[i%len(samples)])
-                    if not hash_key in self.sampleCache:
-                        self.sampleCache[hash_key] = self.st.shiftTempo(samples[i%len(samples)].render(), self.template['tempo']/self.tempo)
-                        section_hash_keys.append(hash_key)
-                    out.append(
-                      item.function(
-                          self.sampleCache[hash_key]
-                      )
-                    )
-        shifted = audio.assemble(out, numChannels = 2)
-        if shifted.numChannels == 1:
-            shifted = self.mono_to_stereo(shifted)
-        for hash_key in section_hash_keys:
-            del self.sampleCache[hash_key]
-        return self.truncatemix(backing, shifted, 0.3)
+    def renderSection(self, j, section, backing, intro, middle):
+        """
+            Compiles one section of the remix - or, in the middle of the song, the intro again.
+        """
+        if j == middle:
+            return self.compileIntro(j, intro)
+        return self.compileSection(j, section, backing)
 
     def remix(self):
         """
@@ -295,10 +225,11 @@ class ElectroHouse(Remixer):
         self.processArt()
 
         self.log("Listening to %s..." % ('"%s"' % self.tag['title'] if 'title' in self.tag else 'song'), 5)
-        self.original = audio.LocalAudioFile(self.infile, False)
+        self.original = self.analyse()
         if not 'title' in self.tag:
             self.detectSong(self.original)
-        self.st = FastModify()
+        self.st = FastModify(workspace=self.workspace)
+        self.stretched = LRUCache(config.electrohouse_cache_bytes)     #   Stretched beats, kept across sections
         
         self.log("Choosing key and tempo...", 10)
         self.tonic = self.original.analysis.key['value']
@@ -308,6 +239,7 @@ class ElectroHouse(Remixer):
         self.bars = self.original.analysis.bars
         self.beats = self.original.analysis.beats
         self.sections = self.original.analysis.sections
+        self.pitches = PitchIndex(self.segmentIndex(self.original.analysis.segments))
         self.tag['key'] = self.keys[self.tonic] if self.tonic >= 0 and self.tonic < 12 else '?'
         if 'title' in self.tag and self.tag['title'] == u'I Wish':
             self.tonic += 2
@@ -315,42 +247,41 @@ class ElectroHouse(Remixer):
         self.tag['tempo'] = self.template['tempo']
 
         self.log("Arranging intro...", 40.0/(len(self.sections) + 1))
-        intro = audio.AudioData(self.sample_path + self.template['intro'], sampleRate=44100, numChannels=2, verbose=False)
+        intro = self.template['intro']
         self.partialEncode(self.compileIntro(0, intro))
+        caches = [self.stretched.stats()]
+        self.stretched.resetCounts()    #   Section workers fork with this cache, and count from here on
 
         i = 0 # Required if there are no sections
         sections = self.sections[1:] if len(self.sections) % 2 else self.sections
         if len(sections) > 2:
-            backing = audio.AudioData(self.sample_path + self.template['body'][self.tonic], sampleRate=44100, numChannels=2, verbose=False)
-            for i, section in enumerate(sections):
+            backing = self.template['body'][self.tonic]
+            arglist = [(n, s, backing, intro, len(sections)/2 + 1) for n, s in enumerate(sections)]
+            rendered = iter(self.mapSections('renderSection', arglist))
+            for i in xrange(len(arglist)):
+                #   Logged before each section is rendered, so its time counts towards its own stage
                 self.log("Arranging section %s of %s..." % (i+1, len(sections)), 40.0/(len(sections) + 1))
-                a = self.compileSection(i, section, backing) if i != (len(sections)/2 + 1) else self.compileIntro(i, intro)
+                a = next(rendered)
                 self.partialEncode(a)
                 del a
+            rendered.close()     #   Lets the section pool, if any, shut down
         self.original.unload()
+        caches.append(self.stretched.stats())
+        caches.extend([stats['stretch_cache'] for stats in self.workerStats.values()])
+        self.stats['stretch_cache'] = combine(caches)
+        self.stretched.clear()
 
         self.log("Adding ending...", 5)
-        self.partialEncode(
-            audio.AudioData(
-                self.sample_path + self.template['splash_ends'][(i + 1) % len(self.template['splash_ends'])],
-                sampleRate=44100,
-                numChannels=2,
-                verbose=False
-            )
-        )
+        self.partialEncode(self.sample(self.template['splash_ends'][(i + 1) % len(self.template['splash_ends'])]))
         
-        self.log("Mixing...", 5)
-        self.mixwav(self.tempfile)
-
         if self.deleteOriginal:
             try:
                 unlink(self.infile)
             except:
                 pass  # File could have been deleted by an eager cleanup script
 
-        self.log("Mastering...", 5)
-        self.lame(self.tempfile, self.outfile)
-        unlink(self.tempfile)
+        self.log("Mastering...", 10)
+        self.master()
         
         self.log("Adding artwork...", 20)
         self.updateTags(titleSuffix = " (Wub Machine Electro Remix)")
@@ -17,6 +17,7 @@ from hashlib import md5
 
 # Wubmachine-specific libraries
 from helpers.remixqueue import RemixQueue
+from helpers.workerpool import WorkerPool
 from helpers.soundcloud import SoundCloud
 from helpers.cleanup import Cleanup
 from helpers.daemon import Daemon
@@ -72,11 +73,24 @@ class ProgressSocket(tornadio.SocketConnection):
     @classmethod
     def update(self, uid, data):
         try:  
-            self.listeners[uid].send(data)
+            self.listeners[uid].sendChanges(data)
         except:
             pass
 
+    def sendChanges(self, data):
+        """
+            Sends only the fields of a progress update that this browser hasn't seen yet.
+            (front.js merges them into what it already has.)
+        """
+        changes = dict([(k, v) for k, v in data.iteritems() if self.sent.get(k, self) != v])
+        self.sent.update(changes)
+        if 'tag' in changes:
+            self.sent['tag'] = dict(changes['tag'])
+        changes['status'] = data['status']
+        self.send(changes)
+
     def on_open(self, *args, **kwargs):
+        self.sent = {}
         try:
             self.uid = kwargs['extra']
             if self.uid in r.finished:
@@ -90,7 +104,7 @@ class ProgressSocket(tornadio.SocketConnection):
                     r.remixers[self.uid].being_watched = True
                     log.info("Remixer %s is now being watched..." % self.uid)
                 r.cleanup()
-                if r.isAvailable():
+                if r.isAvailable() or r.isCached(self.uid):
                     try:
                         r.start(self.uid)
                     except:
@@ -120,20 +134,43 @@ class ProgressSocket(tornadio.SocketConnection):
 
 class MonitorSocket(tornadio.SocketConnection):
     monitors = set()
+    dirty = set()       #   uids that have changed since monitors were last updated
+    timer = None
 
     @classmethod
     def update(self, uid):
+        """
+            Marks a track as changed. Monitors get every changed track (and the overview)
+            at most once every config.monitor_update_interval seconds, no matter how many
+            progress updates came in between.
+        """
+        if isinstance(uid, dict):
+            uid = uid.get('uid')
+        if not uid or not self.monitors:
+            return
+        self.dirty.add(uid)
+        if not self.timer:
+            ioloop = tornado.ioloop.IOLoop.instance()
+            self.timer = ioloop.add_timeout(time.time() + config.monitor_update_interval, self.flush)
+
+    @classmethod
+    def flush(self):
+        self.timer = None
+        uids, self.dirty = self.dirty, set()
         try:
-            if self.monitors:
-                data = MonitorHandler.track(uid)
+            if not self.monitors:
+                return
+            data = [MonitorHandler.track(uid).decode('utf-8') for uid in uids]
+            overview = MonitorHandler.overview()
             for m in self.monitors.copy():
                 try:  
-                    m.send(data.decode('utf-8'))
-                    m.send(MonitorHandler.overview())
+                    for track in data:
+                        m.send(track)
+                    m.send(overview)
                 except:
                     log.error("Failed to send data to monitor.")
         except:
-            log.error("Major failure in MonitorSocket.update.")
+            log.error("Major failure in MonitorSocket.update:\n%s" % traceback.format_exc())
 
     def on_open(self, *args, **kwargs):
         log.info("Opened monitor socket.")
@@ -157,7 +194,8 @@ class MonitorHandler(RequestHandler):
                 'overview': self.overview,
                 'latest': self.latest,
                 'remixqueue': self.remixqueue,
-                'timespan' : self.timespan
+                'timespan' : self.timespan,
+                'metrics': self.metrics
             }
             if sub in sections:
                 self.write(sections[sub]())
@@ -203,6 +241,10 @@ class MonitorHandler(RequestHandler):
         self.set_header("Content-Type", 'text/plain')
         return str("Remixers: %s\nFinished: %s\nQueue:    %s\nRunning:  %s" % (r.remixers, r.finished, r.queue, r.running))
 
+    def metrics(self):
+        self.set_header("Content-Type", 'text/plain; version=0.0.4')
+        return r.exposition()
+
     @classmethod
     def overview(self):
         kwargs = {
@@ -217,6 +259,7 @@ class MonitorHandler(RequestHandler):
             'errorRate': r.errorRate(),
             'errorRateExceeded': r.errorRateExceeded(),
             'isOpen': r.isAccepting(),
+            'cacheHits': r.cacheHits,
             'hour': MonitorHandler.histogram('hours'),
             'day': MonitorHandler.histogram('days'),
             'ever': MonitorHandler.histogram(),
@@ -273,6 +316,7 @@ class MonitorHandler(RequestHandler):
         track.remix = events.get('remix')
         track.share = events.get('share')
         track.download = events.get('download')
+        track.resources = track.remix.usage() if track.remix else None
         track.running = track.uid in r.running or (track.share and track.share.start and not track.share.end and track.share.success is None)
         track.failed = (track.remix and track.remix.success == False) or (track.share and track.share.success == False)
         if track.failed:
@@ -511,7 +555,7 @@ class UploadHandler(RequestHandler):
             else:
                 del self.request.files['upload'][0]['body']
 
-            r.add(self.uid, extension, remixer, ProgressSocket.update, self.trackDone)
+            r.add(self.uid, extension, remixer, ProgressSocket.update, self.trackDone, self.track.hash)
             self.event.success = True
             response = r.waitingResponse(self.uid)
             response['success'] = True
@@ -591,6 +635,10 @@ if __name__ == "__main__":
         r = RemixQueue(MonitorSocket)
         cleanup.remixQueue = r
 
+        if config.worker_pool_size:
+            log.info("\tStarting %s remix workers..." % config.worker_pool_size)
+            r.pool = WorkerPool(r, remixers.values())
+
         log.info("\tInstantiating SoundCloud object...")
         sc = SoundCloud(log)
 
@@ -622,6 +670,11 @@ if __name__ == "__main__":
     finally:
         log.critical("Error: %s" % traceback.format_exc())
         log.critical("IOLoop instance stopped. About to shutdown...")
+        try:
+            if r.pool:
+                r.pool.stop()
+        except:
+            pass
         try:
             cleanup.all()
         except:
@@ -74,7 +74,7 @@
     });
   });
   watch = function(uid) {
-    var s;
+    var s, state;
     s = new io.Socket(window.location.hostname, {
       port: window.wubconfig.socket_io_port,
       resource: window.wubconfig.progress_resource + window.wubconfig.socket_extra_sep + uid,
@@ -89,8 +89,10 @@
       window.log("Socket closed, with data:");
       return window.log(data);
     });
-    s.on('message', function(data) {
-      var displayTag, html;
+    state = {};
+    s.on('message', function(changes) {
+      var data, displayTag, html;
+      data = $.extend(state, changes);
       $('.progress .text').html(data.text);
       switch (data.status) {
         case -1: